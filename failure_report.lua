@@ -15,5 +15,21 @@ local function escape(...)
   return table.concat(command, ' ')
 end
 
+-- Failures are appended to a spool file that the pipeline sends to the
+-- failure server in batches, so reporting never waits on the network.
+-- The file is opened for every line so that the pipeline can rename it
+-- at any time.
+local failure_spool = os.getenv('failure_spool')
+
 function log_failure(status_code, url, downloader, item_type, item_value)
+  if not failure_spool then
+    return
+  end
+
+  local f = io.open(failure_spool, "a")
+  if f then
+    f:write(table.concat({ status_code, url, downloader or "",
+      item_type .. ":" .. item_value }, "\t") .. "\n")
+    f:close()
+  end
 end
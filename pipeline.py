@@ -1,12 +1,23 @@
 # encoding=utf8
+import atexit
+import base64
+import collections
 import datetime
 from distutils.version import StrictVersion
+import functools
+import glob
+import gzip
 import hashlib
+import heapq
+import httplib
+import json
 import os.path
+import Queue
 import random
+import select
 from seesaw.config import realize, NumberConfigValue
-from seesaw.item import ItemInterpolation, ItemValue
-from seesaw.task import SimpleTask, LimitConcurrent
+from seesaw.item import Item, ItemInterpolation, ItemValue
+from seesaw.task import Task, SimpleTask, LimitConcurrent, ConditionalTask
 from seesaw.tracker import GetItemFromTracker, PrepareStatsForTracker, \
     UploadWithTracker, SendDoneToTracker
 import shutil
@@ -15,12 +26,22 @@ import subprocess
 import sys
 import time
 import string
+import tempfile
+import threading
+from tornado.ioloop import IOLoop
+import tornado.web
+import traceback
+import urllib2
+import urlparse
+import uuid
+import zlib
 
 import seesaw
-from seesaw.externalprocess import WgetDownload
+from seesaw.event import Event
+from seesaw.externalprocess import AsyncPopen, ExternalProcess, WgetDownload
 from seesaw.pipeline import Pipeline
 from seesaw.project import Project
-from seesaw.util import find_executable
+from seesaw.util import test_executable
 
 
 # check the seesaw version
@@ -34,7 +55,54 @@ if StrictVersion(seesaw.__version__) < StrictVersion("0.1.5"):
 # WGET_LUA will be set to the first path that
 # 1. does not crash with --version, and
 # 2. prints the required version string
-WGET_LUA = find_executable(
+#
+# Running every candidate takes a while, so the outcome for each path is
+# kept in EXECUTABLE_CACHE with the file's mtime and size, and the path is
+# only run again when those (or the required versions) change.
+EXECUTABLE_CACHE = os.path.join(os.getcwd(), 'data', 'executables.json')
+
+
+def find_executable_cached(name, version, paths, cache_filename):
+    try:
+        with open(cache_filename) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+
+    found = None
+    changed = False
+
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+
+        key = os.path.abspath(path)
+        entry = [stat.st_mtime, stat.st_size, version]
+
+        if key not in cache or cache[key][:3] != entry:
+            cache[key] = entry + [test_executable(name, version, path)]
+            changed = True
+
+        if cache[key][3]:
+            found = path
+            break
+
+    if changed:
+        try:
+            if not os.path.isdir(os.path.dirname(cache_filename)):
+                os.makedirs(os.path.dirname(cache_filename))
+            with open(cache_filename + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.rename(cache_filename + '.tmp', cache_filename)
+        except (IOError, OSError) as error:
+            print('Could not save %s: %s' % (cache_filename, error))
+
+    return found
+
+
+WGET_LUA = find_executable_cached(
     "Wget+Lua",
     ["GNU Wget 1.14.lua.20130523-9a5c"],
     [
@@ -45,131 +113,2041 @@ WGET_LUA = find_executable(
         "../../wget-lua",
         "/home/warrior/wget-lua",
         "/usr/bin/wget-lua"
-    ]
+    ],
+    EXECUTABLE_CACHE
 )
 
-if not WGET_LUA:
-    raise Exception("No usable Wget+Lua found.")
+if not WGET_LUA:
+    raise Exception("No usable Wget+Lua found.")
+
+
+###########################################################################
+# The version number of this pipeline definition.
+#
+# Update this each time you make a non-cosmetic change.
+# It will be added to the WARC files and reported to the tracker.
+VERSION = "20140928.02"
+USER_AGENT = 'ArchiveTeam'
+TRACKER_ID = 'verizon'
+TRACKER_HOST = globals().get('tracker_host', 'tracker.archiveteam.org')
+
+# Passed in with --context-value bind_address=..., which can be a
+# comma-separated list of addresses to spread the items over.
+BIND_ADDRESSES = [address.strip()
+    for address in globals().get('bind_address', '').split(',')
+    if address.strip()]
+
+if BIND_ADDRESSES:
+    print('')
+    print('*** Wget will bind address at {0} ***'.format(
+        ', '.join(BIND_ADDRESSES)))
+    print('')
+
+# Pack items can be split over several Wget+Lua processes. Each process
+# gets its own share of the start URLs and its own WARC file.
+WGET_SHARDS = NumberConfigValue(min=1, max=16,
+    default=globals().get('wget_shards', "1"),
+    name="verizon:wget_shards", title="Wget shards",
+    description="The number of Wget+Lua processes for each pack item.")
+
+# Finished items can be uploaded in batches instead of one rsync run per
+# item. A batch is uploaded when it reaches this size or when its oldest
+# WARC has waited BATCH_UPLOAD_MAX_AGE seconds.
+BATCH_UPLOAD_MB = NumberConfigValue(min=0, max=10000,
+    default=globals().get('batch_upload_mb', "0"),
+    name="verizon:batch_upload_mb", title="Batch upload size",
+    description="Upload finished items in batches of this many megabytes (0 to upload every item on its own).")
+BATCH_UPLOAD_MAX_AGE = 15 * 60
+
+# Items can be claimed from the tracker ahead of time, so that a new item
+# can start downloading right away. Claimed items that have not started
+# after PREFETCH_LEASE seconds are dropped.
+PREFETCH_ITEMS = NumberConfigValue(min=0, max=10,
+    default=globals().get('prefetch_items', "0"),
+    name="verizon:prefetch_items", title="Prefetched items",
+    description="The number of items to claim from the tracker ahead of time.")
+PREFETCH_LEASE = 30 * 60
+
+# These names should all resolve to different addresses. If they do not,
+# we are probably behind a firewall or proxy.
+CHECK_IP_HOSTNAMES = ('twitter.com', 'facebook.com', 'youtube.com',
+    'microsoft.com', 'icanhas.cheezburger.com', 'archiveteam.org')
+CHECK_IP_TTL = 10 * 60
+CHECK_IP_TIMEOUT = 10
+
+# Responses that were archived by earlier items can be written as revisit
+# records instead of being stored again. The dedup index holds up to this
+# many URLs from outside the homepages of the items (shared images and the
+# like).
+DEDUP_ENTRIES = NumberConfigValue(min=0, max=1000000,
+    default=globals().get('dedup_entries', "0"),
+    name="verizon:dedup_entries", title="Dedup index size",
+    description="The number of shared URLs to remember, to store them only once (0 to store everything).")
+
+# verizon.lua reports the URLs it gives up on to the failure server at
+# failure_server (passed in with --context-value). The reports are spooled
+# to a file and sent in batches.
+FAILURE_SPOOL_INTERVAL = 30
+FAILURE_BATCH_SIZE = 500
+
+# Finished WARCs can be recompressed at a higher gzip level than Wget uses,
+# with a CDX index written in the same pass (see recompress-warc.py). Up
+# to RECOMPRESS_PROCESSES items are recompressed at the same time, in their
+# own processes, while the other items go on downloading.
+RECOMPRESS_LEVEL = NumberConfigValue(min=0, max=9,
+    default=globals().get('recompress_level', "0"),
+    name="verizon:recompress_level", title="Recompression level",
+    description="Recompress finished WARCs at this gzip level and upload a CDX index with them (0 to upload them as Wget wrote them).")
+RECOMPRESS_PROCESSES = 2
+
+# Items are only claimed while at least MIN_FREE_DISK_MB megabytes are free
+# in the data directory, and only started, in the order they were claimed,
+# when the space the running items are expected to need still fits, as well
+# as under MAX_IN_FLIGHT_MB if that is set. The expected size of an item is
+# the number of its homepages that exist times a moving average of the WARC
+# size per homepage of earlier items of its type, or ADMISSION_DEFAULT_MB
+# until one has finished.
+MAX_IN_FLIGHT_MB = NumberConfigValue(min=0, max=1000000,
+    default=globals().get('max_in_flight_mb', "0"),
+    name="verizon:max_in_flight_mb", title="In-flight size limit",
+    description="Start no new items while the running items are expected to take up this many megabytes (0 for no limit).")
+MIN_FREE_DISK_MB = NumberConfigValue(min=0, max=1000000,
+    default=globals().get('min_free_disk_mb', "1000"),
+    name="verizon:min_free_disk_mb", title="Minimum free disk space",
+    description="Claim no new items while less than this many megabytes are free.")
+ADMISSION_DEFAULT_MB = 5
+ADMISSION_SMOOTHING = 0.3
+ADMISSION_CHECK_INTERVAL = 10
+
+
+###########################################################################
+# Rate limiting.
+#
+# All Wget+Lua processes of this pipeline share one token bucket per host.
+# A process asks for a token by writing "host<TAB>status<TAB>grant fifo" to
+# the request FIFO after every response, and then blocks reading a line
+# from its own grant FIFO. Waiting that way does not fork a process. The
+# pipeline's own requests (CheckStartURLs) go through RateLimiter.wait,
+# which does the same from a thread, with an empty status before the
+# first response.
+RATE_LIMIT_INITIAL = 1.0
+RATE_LIMIT_MIN = 0.1
+RATE_LIMIT_MAX = 4.0
+RATE_LIMIT_STEP = 0.05
+RATE_LIMIT_BURST = 2
+RATE_LIMIT_HEALTHY_LATENCY = 2.0
+# The sites answer 423 (and others 429) when they want us to slow down.
+RATE_LIMIT_THROTTLED = (423, 429)
+
+
+class TokenBucket(object):
+    '''Paces the requests to one host. The rate creeps up while responses
+    come back quickly and is halved on server and connection errors and
+    when the server asks us to slow down.'''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+
+    def adapt(self, status_code, latency):
+        if status_code == 0 or status_code >= 500 or \
+                status_code in RATE_LIMIT_THROTTLED:
+            self.rate = max(RATE_LIMIT_MIN, self.rate / 2)
+        elif latency is None:
+            pass
+        elif latency < RATE_LIMIT_HEALTHY_LATENCY:
+            self.rate = min(RATE_LIMIT_MAX, self.rate + RATE_LIMIT_STEP)
+        else:
+            self.rate = max(RATE_LIMIT_MIN, self.rate * 0.9)
+
+    def reserve(self, now):
+        '''Takes a token and returns the time at which it may be used.'''
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+
+        if self.tokens >= 0:
+            return now
+        else:
+            return now - self.tokens / self.rate
+
+
+class RateLimiter(object):
+    '''Hands out the tokens. Each bind address has its own bucket for each
+    host. on_response is called with the bind address, host and status
+    code of every response, from the rate limiter's thread.'''
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(prefix='verizon-rate-limiter-')
+        self.request_fifo = os.path.join(self.directory, 'requests.fifo')
+        os.mkfifo(self.request_fifo)
+        self.on_response = Event()
+
+        self._buckets = {}
+        self._addresses = {}
+        self._grant_fifos = {}
+        self._granted = {}
+        self._waited = {}
+        self._pending = []
+        self._lock = threading.Lock()
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def register(self, item, suffix):
+        '''Creates the grant FIFO for a Wget+Lua process of an item.'''
+        filename = rate_grant_fifo(item['item_dir'], suffix)
+        os.mkfifo(filename)
+
+        with self._lock:
+            # Opened for reading and writing so that neither side blocks
+            # on open and the reader never sees EOF.
+            self._grant_fifos[filename] = os.open(filename, os.O_RDWR)
+            self._addresses[filename] = item['bind_address']
+
+        item.on_finish += self.unregister
+
+    def unregister(self, item):
+        prefix = item['item_dir'] + '/'
+
+        with self._lock:
+            for filename in list(self._grant_fifos):
+                if filename.startswith(prefix):
+                    os.close(self._grant_fifos.pop(filename))
+                    self._addresses.pop(filename, None)
+                    self._granted.pop(filename, None)
+                    self._waited.pop(filename, None)
+
+    def wait(self, filename, host, status_code):
+        '''Reports the status code of the last response (None if there was
+        none yet) and blocks the calling thread until the grant FIFO
+        filename gets a token for host.'''
+        with self._lock:
+            grant_fd = self._grant_fifos[filename]
+
+        if status_code is None:
+            status_code = ''
+
+        request_fd = os.open(self.request_fifo, os.O_WRONLY)
+        try:
+            os.write(request_fd, '%s\t%s\t%s\n' % (host, status_code,
+                filename))
+        finally:
+            os.close(request_fd)
+
+        os.read(grant_fd, len('ok\n'))
+
+    def wait_time(self, item):
+        '''Returns the seconds the processes of an item spent waiting for
+        tokens.'''
+        prefix = item['item_dir'] + '/'
+
+        with self._lock:
+            return sum(waited for (filename, waited)
+                in self._waited.iteritems() if filename.startswith(prefix))
+
+    def _run(self):
+        # Opened for reading and writing so that we never see EOF when the
+        # last Wget+Lua process goes away.
+        request_fd = os.open(self.request_fifo, os.O_RDWR)
+        buf = ''
+
+        while True:
+            if self._pending:
+                timeout = max(0, self._pending[0][0] - time.time())
+            else:
+                timeout = None
+
+            if select.select([request_fd], [], [], timeout)[0]:
+                buf += os.read(request_fd, 4096)
+
+                while '\n' in buf:
+                    line, buf = buf.split('\n', 1)
+                    self._handle_request(line)
+
+            self._send_grants()
+
+    def _handle_request(self, line):
+        try:
+            host, status_code, filename = line.split('\t', 2)
+            status_code = int(status_code) if status_code else None
+        except ValueError:
+            return
+
+        now = time.time()
+
+        with self._lock:
+            if filename in self._granted:
+                latency = now - self._granted[filename]
+            else:
+                latency = None
+            address = self._addresses.get(filename)
+
+        if (address, host) not in self._buckets:
+            self._buckets[(address, host)] = TokenBucket(RATE_LIMIT_INITIAL,
+                RATE_LIMIT_BURST)
+
+        bucket = self._buckets[(address, host)]
+
+        if status_code is not None:
+            self.on_response(address, host, status_code)
+            bucket.adapt(status_code, latency)
+
+        heapq.heappush(self._pending, (bucket.reserve(now), filename, now))
+
+    def _send_grants(self):
+        now = time.time()
+
+        while self._pending and self._pending[0][0] <= now:
+            (_, filename, requested) = heapq.heappop(self._pending)
+
+            with self._lock:
+                if filename in self._grant_fifos:
+                    os.write(self._grant_fifos[filename], 'ok\n')
+                    self._granted[filename] = now
+                    self._waited[filename] = \
+                        self._waited.get(filename, 0) + now - requested
+
+
+def rate_grant_fifo(item_dir, suffix):
+    return '%s/rate-limiter%s.fifo' % (item_dir, suffix)
+
+
+RATE_LIMITER = RateLimiter()
+atexit.register(shutil.rmtree, RATE_LIMITER.directory, True)
+
+
+###########################################################################
+# Bind addresses.
+#
+# With several addresses in bind_address, each new item gets the address
+# with the fewest items running on it. The responses of the last
+# BIND_ADDRESS_WINDOW seconds are kept for each address. When at least
+# BIND_ADDRESS_MIN_RESPONSES of them came back and a BIND_ADDRESS_ERROR_RATIO
+# share of those were server errors or 423s (which is how the sites say
+# "slow down"), the address rests: it gets no new items for
+# BIND_ADDRESS_REST seconds. The items that are already running on it
+# carry on.
+BIND_ADDRESS_WINDOW = 5 * 60
+BIND_ADDRESS_MIN_RESPONSES = 20
+BIND_ADDRESS_ERROR_RATIO = 0.2
+BIND_ADDRESS_REST = 15 * 60
+
+
+class BindAddressPool(object):
+    def __init__(self, addresses, window, min_responses, error_ratio,
+            rest):
+        self.addresses = list(addresses)
+        self.window = window
+        self.min_responses = min_responses
+        self.error_ratio = error_ratio
+        self.rest = rest
+
+        self._items = dict((address, 0) for address in self.addresses)
+        self._responses = dict((address, collections.deque())
+            for address in self.addresses)
+        self._resting_until = dict((address, 0) for address in self.addresses)
+        self._lock = threading.Lock()
+
+    def acquire(self, item):
+        '''Sets item['bind_address'] to the address the item should use, or
+        to None if there are no addresses.'''
+        if not self.addresses:
+            item['bind_address'] = None
+            return
+
+        now = time.time()
+
+        with self._lock:
+            awake = [address for address in self.addresses
+                if self._resting_until[address] <= now]
+
+            if awake:
+                address = min(awake, key=lambda address: (
+                    self._items[address], self._error_share(address, now)))
+            else:
+                # All resting: take the one that wakes up first.
+                address = min(self.addresses,
+                    key=lambda address: self._resting_until[address])
+
+            self._items[address] += 1
+
+        item['bind_address'] = address
+        item.on_finish += self.release
+
+    def release(self, item):
+        with self._lock:
+            self._items[item['bind_address']] -= 1
+
+    def record(self, address, host, status_code):
+        if address not in self._responses:
+            return
+
+        now = time.time()
+        error = status_code >= 500 or status_code == 423
+
+        with self._lock:
+            self._responses[address].append((now, error))
+
+            if self._error_share(address, now) >= self.error_ratio and \
+                    len(self._responses[address]) >= self.min_responses:
+                print('Too many errors on %s, giving it no new items for '
+                    '%d seconds.' % (address, self.rest))
+                self._resting_until[address] = now + self.rest
+                self._responses[address].clear()
+
+    def status(self):
+        '''Returns the items, error share and resting time left of each
+        address.'''
+        now = time.time()
+
+        with self._lock:
+            return dict((address, {
+                'items': self._items[address],
+                'error_share': self._error_share(address, now),
+                'resting_seconds': max(0, self._resting_until[address] - now),
+            }) for address in self.addresses)
+
+    def _error_share(self, address, now):
+        responses = self._responses[address]
+
+        while responses and responses[0][0] < now - self.window:
+            responses.popleft()
+
+        if not responses:
+            return 0.0
+
+        return sum(1 for (dummy, error) in responses if error) / \
+            float(len(responses))
+
+
+BIND_ADDRESS_POOL = BindAddressPool(
+    addresses=BIND_ADDRESSES,
+    window=BIND_ADDRESS_WINDOW,
+    min_responses=BIND_ADDRESS_MIN_RESPONSES,
+    error_ratio=BIND_ADDRESS_ERROR_RATIO,
+    rest=BIND_ADDRESS_REST
+)
+RATE_LIMITER.on_response += BIND_ADDRESS_POOL.record
+
+
+###########################################################################
+# Metrics.
+#
+# For every item we record how long each task took, and what the Wget+Lua
+# processes reported: URLs, bytes, retries, time spent sleeping and time
+# spent waiting for the rate limiter. Each finished item is appended as a
+# line of JSON to METRICS_LOG. The totals can also be served in the
+# Prometheus text format: pass in metrics_port to enable that.
+METRICS_LOG = globals().get('metrics_log',
+    os.path.join(os.getcwd(), 'data', 'metrics.jsonl'))
+METRICS_PORT = int(globals().get('metrics_port', "0"))
+WGET_STATS = ('urls', 'bytes', 'retries', 'deferred', 'sleep_seconds')
+
+
+class PipelineMetrics(object):
+    def __init__(self, log_filename):
+        self.log_filename = log_filename
+        self._task_started = {}
+        self._stages = {}
+        self._totals = collections.defaultdict(float)
+        self._items = collections.defaultdict(int)
+        self._stage_seconds = collections.defaultdict(float)
+        self._stage_runs = collections.defaultdict(int)
+
+    def watch(self, pipeline):
+        pipeline.on_start_item += self._start_item
+        pipeline.on_finish_item += self._finish_item
+
+    def _start_item(self, pipeline, item):
+        self._task_started[item] = {}
+        self._stages[item] = collections.defaultdict(float)
+        item['started'] = time.time()
+        item.on_task_status += self._task_status
+
+    def _task_status(self, item, task, status, old_status):
+        if status == Item.TaskStatus.running:
+            self._task_started[item][task] = time.time()
+        elif task in self._task_started[item]:
+            duration = time.time() - self._task_started[item].pop(task)
+            self._stages[item][task.name] += duration
+            self._stage_seconds[task.name] += duration
+            self._stage_runs[task.name] += 1
+
+    def _finish_item(self, pipeline, item):
+        item.on_task_status -= self._task_status
+        del self._task_started[item]
+        stages = self._stages.pop(item)
+
+        if item.completed:
+            outcome = 'completed'
+        elif item.failed:
+            outcome = 'failed'
+        else:
+            outcome = 'canceled'
+
+        self._items[outcome] += 1
+
+        record = {
+            'item_name': item['item_name'] if 'item_name' in item else None,
+            'outcome': outcome,
+            'started': item['started'],
+            'duration': time.time() - item['started'],
+            'stages': stages,
+        }
+
+        for key in ('wget_stats', 'rate_limit_wait', 'warc_size',
+                'bind_address'):
+            if key in item:
+                record[key] = item[key]
+
+        if 'wget_stats' in item:
+            for (key, value) in item['wget_stats'].iteritems():
+                self._totals[key] += value
+        if 'rate_limit_wait' in item:
+            self._totals['rate_limit_wait_seconds'] += item['rate_limit_wait']
+        if 'warc_size' in item:
+            self._totals['warc_bytes'] += item['warc_size']
+
+        if self.log_filename:
+            with open(self.log_filename, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def prometheus_text(self):
+        lines = []
+
+        for (outcome, count) in sorted(self._items.iteritems()):
+            lines.append('verizon_items_total{outcome="%s"} %d' % (
+                outcome, count))
+        for (stage, seconds) in sorted(self._stage_seconds.iteritems()):
+            lines.append('verizon_stage_seconds_total{stage="%s"} %.3f' % (
+                stage, seconds))
+            lines.append('verizon_stage_runs_total{stage="%s"} %d' % (
+                stage, self._stage_runs[stage]))
+        for (key, value) in sorted(self._totals.iteritems()):
+            lines.append('verizon_%s_total %s' % (key, value))
+        for (address, status) in sorted(BIND_ADDRESS_POOL.status().items()):
+            for (key, value) in sorted(status.iteritems()):
+                lines.append('verizon_bind_address_%s{address="%s"} %s' % (
+                    key, address, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def listen(self, port):
+        metrics = self
+
+        class MetricsHandler(tornado.web.RequestHandler):
+            def get(self):
+                self.set_header('Content-Type', 'text/plain; version=0.0.4')
+                self.write(metrics.prometheus_text())
+
+        tornado.web.Application([('/metrics', MetricsHandler)]).listen(port)
+
+
+###########################################################################
+# This section defines project-specific tasks.
+#
+# Simple tasks (tasks that do not need any concurrency) are based on the
+# SimpleTask class and have a process(item) method that is called for
+# each item.
+class CheckIP(SimpleTask):
+    def __init__(self, checker):
+        SimpleTask.__init__(self, "CheckIP")
+        self.checker = checker
+
+    def process(self, item):
+        # NEW for 2014! Check if we are behind firewall/proxy
+
+        # The check runs in the background and its verdict is cached, so
+        # this never waits on DNS. Until the first check has finished
+        # there is no verdict and items go ahead.
+        addresses = self.checker.addresses()
+
+        if addresses is None:
+            return
+
+        unresolved = [hostname for hostname in self.checker.hostnames
+            if hostname not in addresses]
+
+        if unresolved:
+            raise Exception('Could not resolve {0}. Is DNS working?'.format(
+                ', '.join(unresolved)))
+        elif len(set(addresses.values())) != len(self.checker.hostnames):
+            item.log_output('Got IP addresses: {0}'.format(addresses))
+            item.log_output(
+                'Are you behind a firewall/proxy? That is a big no-no!')
+            raise Exception(
+                'Are you behind a firewall/proxy? That is a big no-no!')
+
+
+class IPChecker(object):
+    '''Resolves hostnames that should all have different addresses. All
+    names are looked up at once, and names that do not resolve within
+    timeout seconds are left out. The result is kept for ttl seconds and
+    then refreshed in a background thread. A check in which not every name
+    resolved is not kept, so the next call tries again.'''
+    def __init__(self, hostnames, ttl, timeout,
+            resolver=socket.gethostbyname):
+        self.hostnames = hostnames
+        self.ttl = ttl
+        self.timeout = timeout
+        self.resolver = resolver
+        self._addresses = None
+        self._checked = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+        self._start_refresh()
+
+    def addresses(self):
+        '''Returns a dict of hostname to address from the last check, or
+        None if no check has finished yet.'''
+        with self._lock:
+            addresses = self._addresses
+            stale = self._checked is None or \
+                self._checked + self.ttl < time.time()
+
+        if stale:
+            self._start_refresh()
+
+        return addresses
+
+    def _start_refresh(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        thread = threading.Thread(target=self._refresh)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self):
+        addresses = {}
+
+        def resolve(hostname):
+            try:
+                addresses[hostname] = self.resolver(hostname)
+            except (socket.error, EnvironmentError):
+                pass
+
+        threads = [threading.Thread(target=resolve, args=(hostname,))
+            for hostname in self.hostnames]
+        deadline = time.time() + self.timeout
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+        with self._lock:
+            self._addresses = dict(addresses)
+            if len(addresses) == len(self.hostnames):
+                self._checked = time.time()
+            else:
+                self._checked = None
+            self._refreshing = False
+
+
+class GetItemFromPrefetcher(Task):
+    '''Takes an item that the TrackerPrefetcher has already claimed, so
+    that the item does not have to wait for the tracker. If prefetching is
+    switched off while the item waits, it gets its item from tracker_task
+    instead.'''
+    def __init__(self, prefetcher, tracker_task):
+        Task.__init__(self, "GetItemFromPrefetcher")
+        self.prefetcher = prefetcher
+        self.tracker_task = tracker_task
+        self.tracker_task.on_complete_item += self._tracker_task_complete_item
+        self.tracker_task.on_fail_item += self._tracker_task_fail_item
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+        item.may_be_canceled = True
+        self.prefetcher.take(functools.partial(self.process, item))
+
+    def process(self, item, data):
+        if item.canceled:
+            return False
+
+        if data is None:
+            item.log_output("Prefetching is off, asking the tracker.\n")
+            self.tracker_task.enqueue(item)
+            return True
+
+        item.may_be_canceled = False
+
+        for (key, value) in data.iteritems():
+            item[key] = value
+
+        item.log_output("Received item '%s' from tracker\n" % item["item_name"])
+        self.complete_item(item)
+
+        return True
+
+    def _tracker_task_complete_item(self, task, item):
+        self.complete_item(item)
+
+    def _tracker_task_fail_item(self, task, item):
+        self.fail_item(item)
+
+
+class TrackerPrefetcher(object):
+    '''Claims items from the tracker in the background and keeps up to
+    size of them ready for GetItemFromPrefetcher. Items that have waited
+    longer than lease seconds are dropped, since the tracker may have
+    handed them to someone else by then. No items are claimed while
+    paused() returns true.'''
+    retry_delay = 30
+
+    def __init__(self, tracker_url, size, lease, paused):
+        self.tracker_url = tracker_url
+        self.size = size
+        self.lease = lease
+        self.paused = paused
+        self._items = collections.deque()
+        self._takers = collections.deque()
+        self._condition = threading.Condition()
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def has_items(self):
+        with self._condition:
+            return len(self._items) > 0
+
+    def take(self, callback):
+        '''Calls callback with the next item's tracker data, or with None if
+        prefetching has been switched off and no items are left. The
+        callback returns False if it no longer wants the item.'''
+        self._takers.append(callback)
+        self._hand_out()
+
+    def _hand_out(self):
+        while self._takers:
+            with self._condition:
+                while self._items and \
+                        self._items[0][0] + self.lease < time.time():
+                    print('Dropping prefetched item %s, its lease has '
+                        'expired.' % self._items.popleft()[1]['item_name'])
+
+                if not self._items and realize(self.size) == 0:
+                    data = None
+                elif not self._items:
+                    self._condition.notify()
+                    return
+                else:
+                    # Put back with its claim time if the taker is gone.
+                    (claimed, data) = self._items.popleft()
+                    self._condition.notify()
+
+            if not self._takers.popleft()(data) and data is not None:
+                with self._condition:
+                    self._items.appendleft((claimed, data))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._items) >= realize(self.size) or \
+                        self.paused():
+                    if realize(self.size) == 0 and self._takers:
+                        # Switched off while items were waiting
+                        IOLoop.instance().add_callback(self._hand_out)
+                    self._condition.wait(self.retry_delay)
+
+            try:
+                data = json.loads(tracker_request(self.tracker_url,
+                    'request', {
+                        'downloader': downloader,
+                        'api_version': '2',
+                        'version': VERSION,
+                    }))
+            except (urllib2.URLError, socket.error, ValueError) as error:
+                print('Prefetching an item failed (%s). Retrying after %d '
+                    'seconds...' % (error, self.retry_delay))
+                time.sleep(self.retry_delay)
+                continue
+
+            if 'item_name' not in data:
+                time.sleep(self.retry_delay)
+                continue
+
+            with self._condition:
+                self._items.append((time.time(), data))
+
+            IOLoop.instance().add_callback(self._hand_out)
+
+
+def use_prefetcher(item):
+    # Decided once per item. Items that are still in the buffer are handed
+    # out even after prefetching has been switched off.
+    if 'prefetch' not in item:
+        item['prefetch'] = realize(PREFETCH_ITEMS, item) > 0 or \
+            tracker_prefetcher.has_items()
+
+    return item['prefetch']
+
+
+class WaitForAdmission(Task):
+    '''Holds an item back for as long as check(item) returns a reason to,
+    looking again every ADMISSION_CHECK_INTERVAL seconds. With
+    may_be_canceled, for items that have not been claimed yet, the item
+    can be canceled while it waits, so that stopping does not hang.'''
+    def __init__(self, name, check, may_be_canceled=False):
+        Task.__init__(self, name)
+        self.check = check
+        self.may_be_canceled = may_be_canceled
+
+    def enqueue(self, item):
+        self.start_item(item)
+        self.process(item, None)
+
+    def process(self, item, last_reason):
+        if item.canceled:
+            return
+
+        reason = self.check(item)
+
+        if reason is None:
+            item.may_be_canceled = False
+            self.complete_item(item)
+            return
+
+        item.may_be_canceled = self.may_be_canceled
+
+        if reason != last_reason:
+            item.log_output("Waiting: %s.\n" % reason)
+
+        IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=ADMISSION_CHECK_INTERVAL),
+            functools.partial(self.process, item, reason))
+
+
+class AdmissionControl(object):
+    '''Keeps track of the expected size of the running items, to decide
+    when new items may be claimed (may_claim) and started (admit). Items
+    are started in the order they came to admit, so that a big item is
+    not kept waiting forever by small ones that keep fitting in.'''
+    def __init__(self, directory, max_mb, min_free_mb, default_mb,
+            smoothing):
+        self.directory = directory
+        self.max_mb = max_mb
+        self.min_free_mb = min_free_mb
+        self.default_mb = default_mb
+        self.smoothing = smoothing
+        self._expected = {}
+        self._running = {}
+        self._waiting = []
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def free_mb(self):
+        stat = os.statvfs(self.directory)
+        return stat.f_bavail * stat.f_frsize / 1e6
+
+    def disk_low(self):
+        return self.free_mb() < realize(self.min_free_mb)
+
+    def expected_mb(self, item):
+        # CheckStartURLs has left only the homepages that exist.
+        homepages = max(1, len(item['start_urls']))
+
+        return self._expected.get(item['item_type'], self.default_mb) * \
+            homepages
+
+    def may_claim(self, item):
+        free_mb = self.free_mb()
+        max_mb = realize(self.max_mb)
+
+        if free_mb < realize(self.min_free_mb):
+            return "only %d MB of disk space free" % free_mb
+        elif max_mb > 0 and self._running_mb()[0] >= max_mb:
+            return "running items are expected to take up %d MB" % max_mb
+
+        return None
+
+    def admit(self, item):
+        if item not in self._waiting:
+            self._waiting.append(item)
+            item.on_finish += self.finish
+
+        if self._waiting[0] is not item:
+            return "%s is waiting to start first" % (
+                self._waiting[0]['item_name'])
+
+        expected_mb = self.expected_mb(item)
+
+        if self._running:
+            running_mb, growth_mb = self._running_mb()
+            max_mb = realize(self.max_mb)
+            room_mb = self.free_mb() - realize(self.min_free_mb)
+
+            if max_mb > 0 and running_mb + expected_mb > max_mb:
+                return "%d MB of items running, %d MB more expected" % (
+                    running_mb, expected_mb)
+            elif growth_mb + expected_mb > room_mb:
+                return "%d MB of disk space needed, %d MB left" % (
+                    growth_mb + expected_mb, max(0, room_mb))
+
+        self._waiting.remove(item)
+        self._running[item] = expected_mb
+
+        return None
+
+    def finish(self, item):
+        if item in self._waiting:
+            self._waiting.remove(item)
+            return
+
+        del self._running[item]
+
+        if item.completed and 'warc_size' in item:
+            item_type = item['item_type']
+            size_mb = item['warc_size'] / 1e6 / max(1, len(item['start_urls']))
+
+            if item_type in self._expected:
+                self._expected[item_type] += self.smoothing * (
+                    size_mb - self._expected[item_type])
+            else:
+                self._expected[item_type] = size_mb
+
+    def _running_mb(self):
+        '''Returns the megabytes the running items are expected to take
+        up in all, and how much of that they have not written yet.'''
+        total_mb = 0
+        growth_mb = 0
+
+        for (item, expected_mb) in self._running.iteritems():
+            used_mb = sum(directory_size(item[key]) for key
+                in ('item_dir', 'checkpoint_dir') if key in item) / 1e6
+            total_mb += max(expected_mb, used_mb)
+            growth_mb += max(0, expected_mb - used_mb)
+
+        return (total_mb, growth_mb)
+
+
+def directory_size(dirname):
+    size = 0
+
+    for (root, dirs, files) in os.walk(dirname):
+        for filename in files:
+            try:
+                size += os.path.getsize(os.path.join(root, filename))
+            except OSError:
+                # Wget or a task removed it in the meantime.
+                pass
+
+    return size
+
+
+def tracker_request(tracker_url, command, data):
+    '''Sends a request to the tracker, outside of the IOLoop.'''
+    request = urllib2.Request('%s/%s' % (tracker_url, command),
+        json.dumps(data), {
+            'Content-Type': 'application/json',
+            'User-Agent': ('ArchiveTeam Warrior/%s %s %s' % (
+                seesaw.__version__, seesaw.runner_type,
+                seesaw.warrior_build)).strip(),
+        })
+
+    return urllib2.urlopen(request, timeout=60).read()
+
+
+class PrepareDirectories(SimpleTask):
+    def __init__(self, warc_prefix):
+        SimpleTask.__init__(self, "PrepareDirectories")
+        self.warc_prefix = warc_prefix
+
+    def process(self, item):
+        item_name = item["item_name"]
+        escaped_item_name = item_name.replace(':', '_').replace('/', '_')
+        dirname = "/".join((item["data_dir"], escaped_item_name))
+
+        if os.path.isdir(dirname):
+            shutil.rmtree(dirname)
+
+        os.makedirs(dirname)
+
+        item["item_dir"] = dirname
+        item["warc_file_base"] = "%s-%s-%s" % (self.warc_prefix, escaped_item_name,
+            time.strftime("%Y%m%d-%H%M%S"))
+
+        open("%(item_dir)s/%(warc_file_base)s.warc.gz" % item, "w").close()
+
+        assert ':' in item_name
+        item_type, item_value = item_name.split(':', 1)
+
+        item['item_type'] = item_type
+        item['item_value'] = item_value
+        item['start_urls'] = list(start_urls(item_type, item_value))
+
+        host, suffix_length = ITEM_TYPES[item_type]
+        item['item_host'] = host
+        item['item_suffix_length'] = str(suffix_length)
+        item['warc_parts'] = []
+
+        remove_stale_checkpoints()
+        item['checkpoint_dir'] = os.path.join(CHECKPOINT_DIR,
+            escaped_item_name)
+        shards_file = os.path.join(item['checkpoint_dir'], 'shards')
+
+        if os.path.exists(shards_file):
+            # A resumed item is split the way it was the first time.
+            with open(shards_file) as f:
+                item['wget_shards'] = int(f.read())
+            item['shards_pinned'] = True
+        else:
+            # CheckStartURLs lowers this to the number of homepages that
+            # exist, and then pins it with start_shards.
+            if suffix_length > 0:
+                item['wget_shards'] = min(realize(WGET_SHARDS, item),
+                    len(item['start_urls']))
+            else:
+                item['wget_shards'] = 1
+            item['shards_pinned'] = False
+
+            if not os.path.isdir(item['checkpoint_dir']):
+                os.makedirs(item['checkpoint_dir'])
+
+        BIND_ADDRESS_POOL.acquire(item)
+
+
+def start_shards(item):
+    '''Pins the number of shards in the checkpoint directory, if this is
+    the first run of the item, and creates a grant FIFO for each shard.
+    Called once the number of shards is final.'''
+    if not item['shards_pinned']:
+        with open(os.path.join(item['checkpoint_dir'], 'shards'), 'w') as f:
+            f.write(str(item['wget_shards']))
+        item['shards_pinned'] = True
+
+    for shard in range(item['wget_shards']):
+        RATE_LIMITER.register(item, shard_suffix(shard, item['wget_shards']))
+
+
+class CollectDeferredURLs(SimpleTask):
+    '''Gathers the URLs that Wget+Lua put aside because their host kept
+    failing, so that one more Wget+Lua process can retry them. The URLs
+    that are in the WARC already go in its done file, so that the retry
+    pass does not fetch them again while following links.'''
+    def __init__(self):
+        SimpleTask.__init__(self, "CollectDeferredURLs")
+
+    def process(self, item):
+        urls = []
+        seen = set()
+
+        for filename in sorted(glob.glob("%(item_dir)s/deferred*.txt" % item)):
+            with open(filename) as in_file:
+                for line in in_file:
+                    url = line.strip()
+
+                    if url and url not in seen:
+                        seen.add(url)
+                        urls.append(url)
+
+        item['deferred_urls'] = len(urls)
+
+        if not urls:
+            return
+
+        item.log_output("Retrying %d URLs that were put aside.\n" % len(urls))
+
+        with open("%(item_dir)s/retry-urls.txt" % item, "w") as out_file:
+            for url in urls:
+                out_file.write(url + "\n")
+
+        done = set()
+        for filename in item['warc_parts']:
+            done.update(scan_warc(filename, collect_uris=True)['target_uris'])
+        done.difference_update(urls)
+
+        with open(checkpoint_file(item, 'done', RETRY_SUFFIX), 'w') as out_file:
+            for url in done:
+                out_file.write(url + "\n")
+
+        RATE_LIMITER.register(item, RETRY_SUFFIX)
+        item['warc_parts'].append("%s/%s%s.warc.gz" % (item['item_dir'],
+            item['warc_file_base'], RETRY_SUFFIX))
+
+
+class CollectWgetStats(SimpleTask):
+    '''Adds up the stats that the Wget+Lua processes of an item wrote when
+    they finished, for the metrics.'''
+    def __init__(self):
+        SimpleTask.__init__(self, "CollectWgetStats")
+
+    def process(self, item):
+        stats = dict((key, 0) for key in WGET_STATS)
+
+        for filename in glob.glob('%(item_dir)s/wget-stats*.txt' % item):
+            with open(filename) as f:
+                for line in f:
+                    key, value = line.split()
+                    if key in stats:
+                        stats[key] += float(value)
+
+        item['wget_stats'] = stats
+        item['rate_limit_wait'] = RATE_LIMITER.wait_time(item)
+
+
+class CollectDedupEntries(SimpleTask):
+    '''Reads the CDX files that Wget wrote next to the WARC parts, and
+    keeps the lines of URLs from outside the item's own homepages for the
+    dedup index. Lines of records that were cut off when a segment was
+    truncated are left out.'''
+    def __init__(self):
+        SimpleTask.__init__(self, "CollectDedupEntries")
+
+    def process(self, item):
+        entries = []
+
+        for filename in item['warc_parts']:
+            if not os.path.exists(cdx_filename(filename)):
+                continue
+
+            size = os.path.getsize(filename)
+
+            with open(cdx_filename(filename)) as f:
+                for line in f:
+                    fields = line.split()
+
+                    if len(fields) != 11 or not fields[8].isdigit():
+                        continue
+                    if int(fields[8]) >= size:
+                        continue
+                    if any(fields[0].startswith(url)
+                            for url in item['start_urls']):
+                        continue
+
+                    entries.append(line.rstrip('\n'))
+
+        item['dedup_entries'] = entries
+
+
+class UpdateDedupIndex(SimpleTask):
+    '''Adds the item's entries to the dedup index once the item has been
+    uploaded, so that revisit records never refer to records that were
+    not archived.'''
+    def __init__(self, index):
+        SimpleTask.__init__(self, "UpdateDedupIndex")
+        self.index = index
+
+    def process(self, item):
+        self.index.update(item['dedup_entries'], item['warc_revisit_uris'])
+
+
+class DedupIndex(object):
+    '''A CDX file for Wget's --warc-dedup, with one line for each URL. It
+    holds at most size lines; the URLs that were archived or revisited
+    least recently are dropped first.'''
+    header = ' CDX a b a m s k r M V g u\n'
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        self._entries = collections.OrderedDict()
+
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    if line != self.header:
+                        self._entries[line.split(' ', 1)[0]] = \
+                            line.rstrip('\n')
+
+    def has_entries(self):
+        return len(self._entries) > 0
+
+    def update(self, entries, used_urls):
+        for url in used_urls:
+            if url in self._entries:
+                self._entries[url] = self._entries.pop(url)
+
+        for line in entries:
+            url = line.split(' ', 1)[0]
+            self._entries.pop(url, None)
+            self._entries[url] = line
+
+        while len(self._entries) > realize(self.size):
+            self._entries.popitem(last=False)
+
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        # Wget processes that are starting may be reading the old file.
+        with open(self.filename + '.tmp', 'w') as f:
+            f.write(self.header)
+            for line in self._entries.itervalues():
+                f.write(line + '\n')
+
+        os.rename(self.filename + '.tmp', self.filename)
+
+
+def use_dedup_index(item):
+    return 'dedup_entries' in item and realize(DEDUP_ENTRIES, item) > 0
+
+
+class MergeWarcFiles(SimpleTask):
+    def __init__(self):
+        SimpleTask.__init__(self, "MergeWarcFiles")
+
+    def process(self, item):
+        # A .warc.gz is a series of gzip members, one per record, so the
+        # parts can simply be appended to the item's WARC. The checkpoint
+        # segments are kept until MoveFiles, so that the item can still be
+        # resumed if a later task fails.
+        with open("%(item_dir)s/%(warc_file_base)s.warc.gz" % item, "ab") as out_file:
+            for filename in item['warc_parts']:
+                with open(filename, 'rb') as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+
+                if not filename.startswith(item['checkpoint_dir'] + '/'):
+                    os.remove(filename)
+
+        item['warc_parts'] = []
+
+
+class CheckStartURLs(Task):
+    '''Requests all start URLs of an item concurrently and drops the
+    homepages that do not exist, so Wget+Lua never has to visit them.
+
+    The responses for the missing homepages are written to a WARC file
+    that is queued in item["warc_parts"]. Each thread takes a token from
+    the rate limiter before every request, like a Wget+Lua process.
+    '''
+    def __init__(self, threads):
+        Task.__init__(self, "CheckStartURLs")
+        self.threads = threads
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+
+        item['probe_threads'] = min(self.threads, len(item['start_urls']))
+        for number in range(item['probe_threads']):
+            RATE_LIMITER.register(item, PROBE_SUFFIX + str(number))
+
+        thread = threading.Thread(target=self.process, args=(item,))
+        thread.daemon = True
+        thread.start()
+
+    def process(self, item):
+        try:
+            url_queue = Queue.Queue()
+            for url in item['start_urls']:
+                url_queue.put(url)
+
+            results = {}
+            workers = []
+
+            for number in range(item['probe_threads']):
+                worker = threading.Thread(target=self.probe_urls,
+                    args=(url_queue, results, item['bind_address'],
+                    rate_grant_fifo(item['item_dir'],
+                        PROBE_SUFFIX + str(number))))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+            for worker in workers:
+                worker.join()
+
+            live_urls = []
+            warc_filename = "%(item_dir)s/%(warc_file_base)s-probe.warc.gz" % item
+
+            with open(warc_filename, 'wb') as warc_file:
+                for url in item['start_urls']:
+                    result = results.get(url)
+
+                    if result and is_missing_homepage(result[0], result[1]):
+                        write_warc_records(warc_file, url, result[2], result[3])
+                    else:
+                        live_urls.append(url)
+        except Exception as error:
+            IOLoop.instance().add_callback(functools.partial(self.fail,
+                item, error))
+        else:
+            IOLoop.instance().add_callback(functools.partial(self.finish,
+                item, live_urls, warc_filename))
+
+    def probe_urls(self, url_queue, results, bind_address, grant_fifo):
+        host = None
+        status_code = None
+
+        while True:
+            try:
+                url = url_queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            host = urlparse.urlsplit(url).hostname
+            RATE_LIMITER.wait(grant_fifo, host, status_code)
+
+            try:
+                results[url] = probe_url(url, bind_address)
+                status_code = results[url][0]
+            except (socket.error, httplib.HTTPException):
+                # Leave it to Wget+Lua, which knows how to retry.
+                status_code = 0
+
+        if status_code is not None:
+            # The last response counts too.
+            RATE_LIMITER.wait(grant_fifo, host, status_code)
+
+    def finish(self, item, live_urls, warc_filename):
+        item.log_output("%d of %d homepages exist.\n" % (len(live_urls),
+            len(item['start_urls'])))
+
+        item['start_urls'] = live_urls
+        if not item['shards_pinned']:
+            item['wget_shards'] = min(item['wget_shards'], len(live_urls))
+        item['warc_parts'].append(warc_filename)
+        start_shards(item)
+
+        item.log_output("Finished %s for %s\n" % (self, item.description()))
+        self.complete_item(item)
+
+    def fail(self, item, error):
+        item.log_output("Failed %s for %s\n" % (self, item.description()))
+        item.log_error(self, error)
+        self.fail_item(item)
+
+
+class HTTP10Connection(httplib.HTTPConnection):
+    # HTTP/1.0 keeps servers from using chunked encoding, so the response
+    # can be stored in the WARC the way it was received.
+    _http_vsn = 10
+    _http_vsn_str = 'HTTP/1.0'
+
+
+def probe_url(url, bind_address=None):
+    '''Fetches a URL and returns its status code, Location header and the
+    request and response as they went over the wire.'''
+    parsed = urlparse.urlsplit(url)
+    path = parsed.path or '/'
+
+    if bind_address:
+        source_address = (bind_address, 0)
+    else:
+        source_address = None
+
+    if 'http_proxy' in globals():
+        # Like Wget, send the full URL to the proxy.
+        connection = HTTP10Connection(
+            urlparse.urlsplit(globals()['http_proxy']).netloc, timeout=30,
+            source_address=source_address)
+        target = url
+    else:
+        connection = HTTP10Connection(parsed.netloc, timeout=30,
+            source_address=source_address)
+        target = path
+
+    headers = [
+        ('User-Agent', USER_AGENT),
+        ('Accept', '*/*'),
+        ('Host', parsed.netloc),
+    ]
+    request = 'GET %s HTTP/1.0\r\n%s\r\n' % (target,
+        ''.join('%s: %s\r\n' % header for header in headers))
+
+    try:
+        connection.putrequest('GET', target, skip_host=True,
+            skip_accept_encoding=True)
+        for (name, value) in headers:
+            connection.putheader(name, value)
+        connection.endheaders()
+
+        response = connection.getresponse()
+        body = response.read()
+        response_bytes = 'HTTP/1.%d %d %s\r\n%s\r\n%s' % (
+            response.version % 10, response.status, response.reason,
+            ''.join(response.msg.headers), body)
+
+        return (response.status, response.getheader('Location'), request,
+            response_bytes)
+    finally:
+        connection.close()
+
+
+# Where mysite.verizon.net and members.bellatlantic.net send visitors of
+# homepages that do not exist.
+MISSING_HOMEPAGE_REDIRECTS = frozenset([
+    'http://entertainment.verizon.com/',
+    'http://verizon.net/',
+    'https://verizon.net/',
+    'http://www.verizon.net/',
+    'https://www.verizon.net/',
+    'http://bellatlantic.net/',
+    'https://bellatlantic.net/',
+    'http://www.bellatlantic.net/',
+    'https://www.bellatlantic.net/',
+])
+
+
+def is_missing_homepage(status_code, location):
+    if status_code == 404:
+        return True
+    elif 300 <= status_code < 400:
+        return location in MISSING_HOMEPAGE_REDIRECTS
+    else:
+        return False
+
+
+def write_warc_records(warc_file, url, request, response):
+    '''Appends a request and a response record, each as its own gzip
+    member, to a .warc.gz file.'''
+    date = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    response_id = '<urn:uuid:%s>' % uuid.uuid4()
+
+    for (warc_type, record_id, block, extra_headers) in [
+            ('request', '<urn:uuid:%s>' % uuid.uuid4(), request,
+                'WARC-Concurrent-To: %s\r\n' % response_id
+                + 'Content-Type: application/http;msgtype=request\r\n'),
+            ('response', response_id, response,
+                'Content-Type: application/http;msgtype=response\r\n')]:
+        header = 'WARC/1.0\r\n' \
+            'WARC-Type: %s\r\n' \
+            'WARC-Target-URI: %s\r\n' \
+            'WARC-Date: %s\r\n' \
+            'WARC-Record-ID: %s\r\n' \
+            'WARC-Block-Digest: sha1:%s\r\n' \
+            '%s' \
+            'Content-Length: %d\r\n' \
+            '\r\n' % (warc_type, url, date, record_id,
+                base64.b32encode(hashlib.sha1(block).digest()),
+                extra_headers, len(block))
+
+        gzip_file = gzip.GzipFile(fileobj=warc_file, mode='wb')
+        gzip_file.write(header + block + '\r\n\r\n')
+        gzip_file.close()
+
+
+class MoveFiles(SimpleTask):
+    def __init__(self):
+        SimpleTask.__init__(self, "MoveFiles")
+
+    def process(self, item):
+        # NEW for 2014! Check if wget was compiled with zlib support
+        if os.path.exists("%(item_dir)s/%(warc_file_base)s.warc"):
+            raise Exception('Please compile wget with zlib support!')
+
+        os.rename("%(item_dir)s/%(warc_file_base)s.warc.gz" % item,
+              "%(data_dir)s/%(warc_file_base)s.warc.gz" % item)
+
+        if use_recompression(item):
+            os.rename("%(item_dir)s/%(warc_file_base)s.cdx" % item,
+                  "%(data_dir)s/%(warc_file_base)s.cdx" % item)
+
+        shutil.rmtree("%(item_dir)s" % item)
+        shutil.rmtree("%(checkpoint_dir)s" % item)
+
+
+class QueueForBatchUpload(SimpleTask):
+    '''Hands the item's WARC and tracker stats to the BatchUploader.
+
+    The item leaves the pipeline right away; the BatchUploader sends it to
+    the tracker as done, and adds its entries to the dedup index, once its
+    batch has been uploaded.'''
+    def __init__(self, uploader):
+        SimpleTask.__init__(self, "QueueForBatchUpload")
+        self.uploader = uploader
+
+    def process(self, item):
+        if use_dedup_index(item):
+            dedup = (item['dedup_entries'], item['warc_revisit_uris'])
+        else:
+            dedup = ([], [])
+
+        self.uploader.add("%(data_dir)s/%(warc_file_base)s.warc.gz" % item,
+            item['item_name'], item['stats'], use_recompression(item), *dedup)
+
+        item.log_output("Queued for upload in the next batch.\n")
+
+
+class BatchUploader(object):
+    '''Collects finished WARCs in a spool directory and uploads them with a
+    single rsync run once they add up to size_mb megabytes or the oldest
+    one has waited max_age seconds. Each WARC has a .json file next to it
+    with the item name, tracker stats and dedup entries, so a restarted
+    pipeline picks up where it left off.
+
+    The uploader only starts once an item is added, or if the spool has
+    items from an earlier run. When the pipeline stops, whatever is left
+    in the spool is uploaded before it exits (flush).'''
+    def __init__(self, tracker_url, spool_dir, size_mb, max_age, dedup_index):
+        self.tracker_url = tracker_url
+        self.spool_dir = spool_dir
+        self.size_mb = size_mb
+        self.max_age = max_age
+        self.dedup_index = dedup_index
+        self._started = False
+        self._lock = threading.Lock()
+
+        if glob.glob(os.path.join(self.spool_dir, '*.warc.gz.json')):
+            self._start()
+
+    def _start(self):
+        if self._started:
+            return
+        self._started = True
+
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+        atexit.register(self.flush)
+
+    def add(self, filename, item_name, stats, with_cdx=False,
+            dedup_entries=[], revisit_uris=[]):
+        self._start()
+
+        warc_filename = os.path.join(self.spool_dir,
+            os.path.basename(filename))
+        os.rename(filename, warc_filename)
 
+        if with_cdx:
+            os.rename(cdx_filename(filename), cdx_filename(warc_filename))
 
-###########################################################################
-# The version number of this pipeline definition.
-#
-# Update this each time you make a non-cosmetic change.
-# It will be added to the WARC files and reported to the tracker.
-VERSION = "20140928.02"
-USER_AGENT = 'ArchiveTeam'
-TRACKER_ID = 'verizon'
-TRACKER_HOST = 'tracker.archiveteam.org'
+        # Written last, under a temporary name, so that the uploader never
+        # sees a manifest without its WARC.
+        with open(warc_filename + '.json.tmp', 'w') as out_file:
+            json.dump({
+                'item_name': item_name,
+                'stats': stats,
+                'dedup_entries': dedup_entries,
+                'revisit_uris': revisit_uris,
+            }, out_file)
 
+        os.rename(warc_filename + '.json.tmp', warc_filename + '.json')
 
-###########################################################################
-# This section defines project-specific tasks.
-#
-# Simple tasks (tasks that do not need any concurrency) are based on the
-# SimpleTask class and have a process(item) method that is called for
-# each item.
-class CheckIP(SimpleTask):
-    def __init__(self):
-        SimpleTask.__init__(self, "CheckIP")
-        self._counter = 0
+    def _run(self):
+        while True:
+            time.sleep(30)
 
-    def process(self, item):
-        # NEW for 2014! Check if we are behind firewall/proxy
+            try:
+                with self._lock:
+                    batch = self._ready_batch()
+
+                    if batch:
+                        # The index belongs to the IOLoop thread, like in
+                        # UpdateDedupIndex.
+                        self._upload(batch, lambda *args:
+                            IOLoop.instance().add_callback(functools.partial(
+                                self.dedup_index.update, *args)))
+            except Exception:
+                print('Batch upload failed, trying again later:')
+                traceback.print_exc()
+
+    def flush(self):
+        '''Uploads all items in the spool, however small the batch. Called
+        when the pipeline exits, once the IOLoop has stopped.'''
+        with self._lock:
+            batch = self._spooled()
+
+            if not batch:
+                return
 
-        if self._counter <= 0:
-            item.log_output('Checking IP address.')
-            ip_set = set()
-
-            ip_set.add(socket.gethostbyname('twitter.com'))
-            ip_set.add(socket.gethostbyname('facebook.com'))
-            ip_set.add(socket.gethostbyname('youtube.com'))
-            ip_set.add(socket.gethostbyname('microsoft.com'))
-            ip_set.add(socket.gethostbyname('icanhas.cheezburger.com'))
-            ip_set.add(socket.gethostbyname('archiveteam.org'))
-
-            if len(ip_set) != 6:
-                item.log_output('Got IP addresses: {0}'.format(ip_set))
-                item.log_output(
-                    'Are you behind a firewall/proxy? That is a big no-no!')
-                raise Exception(
-                    'Are you behind a firewall/proxy? That is a big no-no!')
-
-        # Check only occasionally
-        if self._counter <= 0:
-            self._counter = 10
+            print('Uploading the %d items that are waiting for a batch before '
+                'stopping.' % len(batch))
+
+            try:
+                self._upload(batch, self.dedup_index.update)
+            except Exception:
+                print('Batch upload failed, the items stay in %s for the next '
+                    'run:' % self.spool_dir)
+                traceback.print_exc()
+
+    def _spooled(self):
+        batch = sorted(glob.glob(os.path.join(self.spool_dir, '*.warc.gz')),
+            key=os.path.getmtime)
+
+        return [filename for filename in batch
+            if os.path.exists(filename + '.json')]
+
+    def _ready_batch(self):
+        batch = self._spooled()
+
+        if not batch:
+            return None
+
+        size_mb = sum(os.path.getsize(filename) for filename in batch) / 1e6
+        age = time.time() - os.path.getmtime(batch[0])
+        threshold = realize(self.size_mb)
+
+        if threshold == 0 or size_mb >= threshold or age >= self.max_age:
+            return batch
         else:
-            self._counter -= 1
+            return None
 
+    def _upload(self, batch, update_dedup_index):
+        manifests = []
+        for filename in batch:
+            with open(filename + '.json') as in_file:
+                manifests.append(json.load(in_file))
 
-class PrepareDirectories(SimpleTask):
-    def __init__(self, warc_prefix):
-        SimpleTask.__init__(self, "PrepareDirectories")
-        self.warc_prefix = warc_prefix
+        upload_target = tracker_request(self.tracker_url, 'upload', {
+            'downloader': downloader,
+            'version': VERSION,
+            'item_name': manifests[0]['item_name'],
+        })
+        upload_target = json.loads(upload_target)['upload_target']
 
-    def process(self, item):
-        item_name = item["item_name"]
-        escaped_item_name = item_name.replace(':', '_').replace('/', '_')
-        dirname = "/".join((item["data_dir"], escaped_item_name))
+        if not upload_target.startswith('rsync://'):
+            raise Exception('Batches can only be uploaded with rsync, got %s.'
+                % upload_target)
 
-        if os.path.isdir(dirname):
-            shutil.rmtree(dirname)
+        print('Uploading %d items with rsync to %s' % (len(batch),
+            upload_target))
 
-        os.makedirs(dirname)
+        process = subprocess.Popen([
+                "rsync",
+                "-avz",
+                "--compress-level=9",
+                "--timeout=300",
+                "--contimeout=300",
+                "--recursive",
+                "--partial",
+                "--partial-dir", ".rsync-tmp",
+                "--files-from=-",
+                self.spool_dir + '/',
+                upload_target
+            ], stdin=subprocess.PIPE)
+        files = batch + [cdx_filename(filename) for filename in batch
+            if os.path.exists(cdx_filename(filename))]
+        process.communicate(''.join(os.path.basename(filename) + '\n'
+            for filename in files))
 
-        item["item_dir"] = dirname
-        item["warc_file_base"] = "%s-%s-%s" % (self.warc_prefix, escaped_item_name,
-            time.strftime("%Y%m%d-%H%M%S"))
+        if process.returncode != 0:
+            raise Exception('rsync returned exit code %d.' % process.returncode)
 
-        open("%(item_dir)s/%(warc_file_base)s.warc.gz" % item, "w").close()
+        for (filename, manifest) in zip(batch, manifests):
+            response = tracker_request(self.tracker_url, 'done',
+                manifest['stats'])
 
+            if response.strip() != 'OK':
+                raise Exception('Tracker responded with unexpected %r.'
+                    % response.strip())
 
-class MoveFiles(SimpleTask):
+            print('Tracker confirmed item %s.' % manifest['item_name'])
+
+            if manifest.get('dedup_entries') or manifest.get('revisit_uris'):
+                update_dedup_index(manifest['dedup_entries'],
+                    manifest['revisit_uris'])
+
+            os.remove(filename + '.json')
+            if os.path.exists(cdx_filename(filename)):
+                os.remove(cdx_filename(filename))
+            os.remove(filename)
+
+
+def use_batch_upload(item):
+    # Decided once per item, in case the setting changes halfway.
+    if 'batch_upload' not in item:
+        item['batch_upload'] = realize(BATCH_UPLOAD_MB, item) > 0
+
+    return item['batch_upload']
+
+
+def use_recompression(item):
+    # Decided once per item, like use_batch_upload.
+    if 'recompress_level' not in item:
+        item['recompress_level'] = realize(RECOMPRESS_LEVEL, item)
+
+    return item['recompress_level'] > 0
+
+
+def cdx_filename(warc_filename):
+    return warc_filename[:-len('.warc.gz')] + '.cdx'
+
+
+class FailureReporter(object):
+    '''Sends the failures that verizon.lua appends to spool_file to the
+    failure server, batch_size at a time, every interval seconds. The
+    spool file is renamed before it is read; batches that cannot be sent
+    are kept and tried again the next time.'''
+    def __init__(self, server_url, spool_file, batch_size, interval):
+        self.server_url = server_url
+        self.spool_file = spool_file
+        self.batch_size = batch_size
+        self.interval = interval
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+    def flush(self):
+        if os.path.exists(self.spool_file):
+            os.rename(self.spool_file, '%s.%d' % (self.spool_file,
+                time.time() * 1000))
+            # A Wget+Lua process that opened the file just before it was
+            # renamed may still be writing its line.
+            time.sleep(1)
+
+        for filename in sorted(glob.glob(self.spool_file + '.*')):
+            if filename.endswith('.tmp'):
+                continue
+
+            with open(filename) as f:
+                failures = [line.rstrip('\n').split('\t') for line in f]
+
+            failures = [{
+                'response_code': fields[0],
+                'url': fields[1],
+                'downloader': fields[2],
+                'item_name': fields[3],
+            } for fields in failures if len(fields) == 4]
+
+            for start in range(0, len(failures), self.batch_size):
+                request = urllib2.Request(self.server_url + '/fail/bulk',
+                    json.dumps(failures[start:start + self.batch_size]),
+                    {'Content-Type': 'application/json'})
+
+                try:
+                    urllib2.urlopen(request, timeout=60).read()
+                except (urllib2.URLError, socket.error) as error:
+                    print('Sending failures failed (%s). Trying again in %d '
+                        'seconds.' % (error, self.interval))
+                    self._keep(filename, failures[start:])
+                    return
+
+            os.remove(filename)
+
+    def _keep(self, filename, failures):
+        with open(filename + '.tmp', 'w') as f:
+            for failure in failures:
+                f.write('\t'.join((failure['response_code'], failure['url'],
+                    failure['downloader'], failure['item_name'])) + '\n')
+
+        os.rename(filename + '.tmp', filename)
+
+
+class VerifyWarc(SimpleTask):
+    '''Reads the item's WARC once, in fixed-size chunks, to make sure that
+    every gzip member decompresses and to collect the size, SHA1 and
+    record counts for the tracker.'''
     def __init__(self):
-        SimpleTask.__init__(self, "MoveFiles")
+        SimpleTask.__init__(self, "VerifyWarc")
 
     def process(self, item):
-        # NEW for 2014! Check if wget was compiled with zlib support
-        if os.path.exists("%(item_dir)s/%(warc_file_base)s.warc"):
-            raise Exception('Please compile wget with zlib support!')
+        info = scan_warc("%(item_dir)s/%(warc_file_base)s.warc.gz" % item)
 
-        os.rename("%(item_dir)s/%(warc_file_base)s.warc.gz" % item,
-              "%(data_dir)s/%(warc_file_base)s.warc.gz" % item)
+        item.log_output("WARC has %d bytes and %s.\n" % (info['size'],
+            ', '.join('%d %s records' % (count, warc_type)
+                for (warc_type, count) in sorted(info['records'].items()))))
 
-        shutil.rmtree("%(item_dir)s" % item)
+        item['warc_size'] = info['size']
+        item['warc_sha1'] = info['sha1']
+        item['warc_records'] = info['records']
+        item['warc_revisit_uris'] = info['revisit_uris']
+
+
+CHUNK_SIZE = 65536
+
+
+def scan_warc(filename, collect_uris=False):
+    '''Decompresses a .warc.gz chunk by chunk and returns its size, SHA1
+    and the number of records of each type. Memory use does not depend
+    on the size of the file, unless the target URIs are collected too.'''
+    digest = hashlib.sha1()
+    size = 0
+    counter = WarcRecordCounter(collect_uris=collect_uris)
+    decompressor = None
+
+    with open(filename, 'rb') as in_file:
+        for data in iter(functools.partial(in_file.read, CHUNK_SIZE), ''):
+            digest.update(data)
+            size += len(data)
+
+            while data:
+                if decompressor is None:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+                try:
+                    counter.feed(decompressor.decompress(data))
+                except zlib.error as error:
+                    raise Exception('Corrupt gzip member near byte %d of %s: %s'
+                        % (size, filename, error))
+
+                # Whatever follows the end of a member starts the next one.
+                data = decompressor.unused_data
+                if data:
+                    decompressor = None
+
+    if decompressor is not None and not gzip_member_finished(decompressor):
+        raise Exception('%s ends in the middle of a gzip member.' % filename)
+
+    counter.close()
+
+    return {
+        'size': size,
+        'sha1': digest.hexdigest(),
+        'records': counter.records,
+        'revisit_uris': counter.revisit_uris,
+        'target_uris': counter.target_uris,
+    }
+
+
+def gzip_member_finished(decompressor):
+    # Python 2 has no decompressobj.eof, but a finished stream passes any
+    # further input through to unused_data.
+    try:
+        decompressor.decompress('\x01')
+    except zlib.error:
+        return False
+
+    return decompressor.unused_data == '\x01'
+
+
+def truncate_warc(filename):
+    '''Cuts a .warc.gz back to the end of its last complete record, for
+    when Wget was stopped while writing it. Wget writes the request record
+    before its response, so a request without a response is cut as well.
+    Returns the target URIs of the response and revisit records that are
+    left.'''
+    uris = []
+    offset = 0
+    position = 0
+    decompressor = None
+    broken = False
+
+    with open(filename, 'r+b') as warc_file:
+        for data in iter(functools.partial(warc_file.read, CHUNK_SIZE), ''):
+            position += len(data)
+
+            while data and not broken:
+                if decompressor is None:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    counter = WarcRecordCounter(collect_uris=True)
+
+                try:
+                    counter.feed(decompressor.decompress(data))
+                except Exception:
+                    broken = True
+                    break
+
+                # Whatever follows the end of a member starts the next one.
+                data = decompressor.unused_data
+
+                if data:
+                    if not records_complete(counter):
+                        broken = True
+                        break
+
+                    uris.extend(counter.target_uris)
+                    if counter.last_type != 'request':
+                        offset = position - len(data)
+                    decompressor = None
+
+            if broken:
+                break
+
+        if not broken and decompressor is not None and \
+                gzip_member_finished(decompressor) and \
+                records_complete(counter) and \
+                counter.last_type != 'request':
+            uris.extend(counter.target_uris)
+            offset = position
+
+        if offset < os.path.getsize(filename):
+            warc_file.truncate(offset)
+
+    return uris
+
+
+def records_complete(counter):
+    try:
+        counter.close()
+    except Exception:
+        return False
+
+    return True
+
+
+class WarcRecordCounter(object):
+    '''Counts WARC records by type in a stream of decompressed data, which
+    may be split anywhere. With collect_uris, it also lists the target URIs
+    of the response and revisit records.'''
+    max_header_size = 65536
+
+    def __init__(self, collect_uris=False):
+        self.records = {}
+        self.target_uris = [] if collect_uris else None
+        self.revisit_uris = []
+        self.last_type = None
+        self._buffer = ''
+        self._remaining = 0
+
+    def feed(self, data):
+        while data:
+            if self._remaining:
+                # Skip the record block and the two CRLFs after it.
+                skipped = min(self._remaining, len(data))
+                self._remaining -= skipped
+                data = data[skipped:]
+                continue
+
+            self._buffer += data
+            end = self._buffer.find('\r\n\r\n')
+
+            if end < 0:
+                if len(self._buffer) > self.max_header_size:
+                    raise Exception('WARC record header is too long.')
+                return
+
+            data = self._buffer[end + 4:]
+            self._read_header(self._buffer[:end])
+            self._buffer = ''
+
+    def _read_header(self, header):
+        lines = header.split('\r\n')
+
+        if not lines[0].startswith('WARC/'):
+            raise Exception('Expected a WARC record, got %r.' % lines[0][:40])
+
+        fields = {}
+        for line in lines[1:]:
+            name, dummy, value = line.partition(':')
+            fields[name.strip().lower()] = value.strip()
+
+        warc_type = fields.get('warc-type', 'unknown')
+        self.records[warc_type] = self.records.get(warc_type, 0) + 1
+        self.last_type = warc_type
+
+        if warc_type in ('response', 'revisit') and \
+                'warc-target-uri' in fields:
+            uri = fields['warc-target-uri'].strip('<>')
+
+            if self.target_uris is not None:
+                self.target_uris.append(uri)
+            if warc_type == 'revisit':
+                self.revisit_uris.append(uri)
+        self._remaining = int(fields['content-length']) + 4
+
+    def close(self):
+        if self._remaining or self._buffer.strip():
+            raise Exception('WARC ends in the middle of a record.')
 
 
 def get_hash(filename):
+    digest = hashlib.sha1()
+
     with open(filename, 'rb') as in_file:
-        return hashlib.sha1(in_file.read()).hexdigest()
+        for data in iter(functools.partial(in_file.read, CHUNK_SIZE), ''):
+            digest.update(data)
+
+    return digest.hexdigest()
 
 
 CWD = os.getcwd()
-PIPELINE_SHA1 = get_hash(os.path.join(CWD, 'pipeline.py'))
-LUA_SHA1 = get_hash(os.path.join(CWD, 'verizon.lua'))
+SOURCE_HASHES = {}
+
+
+def source_hash(filename):
+    # Hashed when the first item is done rather than at load time, and
+    # only once.
+    if filename not in SOURCE_HASHES:
+        SOURCE_HASHES[filename] = get_hash(os.path.join(CWD, filename))
+
+    return SOURCE_HASHES[filename]
 
 
 def stats_id_function(item):
     # NEW for 2014! Some accountability hashes and stats.
     d = {
-        'pipeline_hash': PIPELINE_SHA1,
-        'lua_hash': LUA_SHA1,
+        'pipeline_hash': source_hash('pipeline.py'),
+        'lua_hash': source_hash('verizon.lua'),
         'python_version': sys.version,
+        'warc_size': item['warc_size'],
+        'warc_sha1': item['warc_sha1'],
+        'warc_records': item['warc_records'],
     }
 
     return d
 
 
+# The item types. An item is one homepage ("verizon:joe") or a pack of
+# homepages that share a prefix: "verizon36pack:ab" stands for "ab0" to
+# "abz", and "verizon1296pack:ab" for "ab00" to "abzz". verizon.lua gets
+# the host, suffix length and alphabet of the item through its
+# environment, so adding a pack size takes one line here.
+ITEM_ALPHABET = string.digits + string.lowercase
+ITEM_TYPES = {
+    # item type: (host, suffix length)
+    'verizon': ('mysite.verizon.net', 0),
+    'bellatlantic': ('members.bellatlantic.net', 0),
+    'verizon36pack': ('mysite.verizon.net', 1),
+    'bellatlantic36pack': ('members.bellatlantic.net', 1),
+    'verizon1296pack': ('mysite.verizon.net', 2),
+    'bellatlantic1296pack': ('members.bellatlantic.net', 2),
+}
+
+
+def start_urls(item_type, item_value):
+    if item_type not in ITEM_TYPES:
+        raise Exception('Unknown item')
+
+    host, suffix_length = ITEM_TYPES[item_type]
+
+    for directory in item_directories(item_value, suffix_length):
+        yield 'http://{0}/{1}/'.format(host, directory)
+
+
+def item_directories(item_value, suffix_length):
+    # The last character changes slowest, so that neighbouring homepages
+    # end up in different shards.
+    if suffix_length == 0:
+        yield item_value
+        return
+
+    for last in ITEM_ALPHABET:
+        for directory in item_directories(item_value, suffix_length - 1):
+            yield directory + last
+
+
 class WgetArgs(object):
     def realize(self, item):
+        return self.realize_shard(item, 0, 1)
+
+    def realize_shard(self, item, shard, shards):
+        suffix = shard_suffix(shard, shards)
+        wget_args = self.common_args(item, suffix)
+
+        # Shard N gets every Nth start URL so that each shard sees a similar
+        # mix of existing and missing homepages.
+        wget_args.extend(checkpoint_args(item, suffix,
+            item['start_urls'][shard::shards]))
+
+        return realize(wget_args, item)
+
+    def common_args(self, item, suffix):
         wget_args = [
             WGET_LUA,
             "-U", USER_AGENT,
             "-nv",
             "--lua-script", "verizon.lua",
-            "-o", ItemInterpolation("%(item_dir)s/wget.log"),
+            "-o", ItemInterpolation("%(item_dir)s/wget" + suffix + ".log"),
             "--no-check-certificate",
-            "--output-document", ItemInterpolation("%(item_dir)s/wget.tmp"),
+            "--output-document", ItemInterpolation("%(item_dir)s/wget" + suffix + ".tmp"),
             "--truncate-output",
             "-e", "robots=off",
             "--no-cookies",
@@ -182,263 +2160,241 @@ class WgetArgs(object):
             "--span-hosts",
             "--waitretry", "30",
             "--domains", "mysite.verizon.net,members.bellatlantic.net",
-            "--warc-file", ItemInterpolation("%(item_dir)s/%(warc_file_base)s"),
             "--warc-header", "operator: Archive Team",
             "--warc-header", "verizon-dld-script-version: " + VERSION,
             "--warc-header", ItemInterpolation("verizon-user: %(item_name)s"),
         ]
-        
-        item_name = item['item_name']
-        assert ':' in item_name
-        item_type, item_value = item_name.split(':', 1)
-        
-        item['item_type'] = item_type
-        item['item_value'] = item_value
-        
-        assert item_type in ('verizon', 'bellatlantic', 'bellatlantic36pack', 'verizon36pack', 'verizon1296pack', 'bellatlantic1296pack')
-        
-        if item_type == 'verizon':
-            wget_args.append('http://mysite.verizon.net/{0}/'.format(item_value))
-        elif item_type == 'bellatlantic':
-            wget_args.append('http://members.bellatlantic.net/{0}/'.format(item_value))
-        elif item_type == 'bellatlantic36pack':
-            wget_args.append('http://members.bellatlantic.net/{0}0/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}1/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}2/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}3/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}4/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}5/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}6/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}7/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}8/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}9/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}a/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}b/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}c/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}d/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}e/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}f/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}g/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}h/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}i/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}j/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}k/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}l/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}m/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}n/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}o/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}p/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}q/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}r/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}s/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}t/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}u/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}v/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}w/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}x/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}y/'.format(item_value))
-            wget_args.append('http://members.bellatlantic.net/{0}z/'.format(item_value))
-        elif item_type == 'verizon36pack':
-            wget_args.append('http://mysite.verizon.net/{0}0/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}1/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}2/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}3/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}4/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}5/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}6/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}7/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}8/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}9/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}a/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}b/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}c/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}d/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}e/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}f/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}g/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}h/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}i/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}j/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}k/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}l/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}m/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}n/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}o/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}p/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}q/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}r/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}s/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}t/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}u/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}v/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}w/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}x/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}y/'.format(item_value))
-            wget_args.append('http://mysite.verizon.net/{0}z/'.format(item_value))
-        elif item_type == 'verizon1296pack':
-            suffixes = string.digits + string.lowercase
-
-            for args in [('http://mysite.verizon.net/{0}0{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}1{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}2{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}3{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}4{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}5{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}6{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}7{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}8{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}9{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}a{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}b{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}c{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}d{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}e{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}f{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}g{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}h{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}i{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}j{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}k{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}l{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}m{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}n{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}o{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}p{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}q{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}r{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}s{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}t{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}u{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}v{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}w{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}x{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}y{1}/'.format(item_value, s), \
-                          'http://mysite.verizon.net/{0}z{1}/'.format(item_value, s)) for s in suffixes]:
-                wget_args.append(args[0])
-                wget_args.append(args[1])
-                wget_args.append(args[2])
-                wget_args.append(args[3])
-                wget_args.append(args[4])
-                wget_args.append(args[5])
-                wget_args.append(args[6])
-                wget_args.append(args[7])
-                wget_args.append(args[8])
-                wget_args.append(args[9])
-                wget_args.append(args[10])
-                wget_args.append(args[11])
-                wget_args.append(args[12])
-                wget_args.append(args[13])
-                wget_args.append(args[14])
-                wget_args.append(args[15])
-                wget_args.append(args[16])
-                wget_args.append(args[17])
-                wget_args.append(args[18])
-                wget_args.append(args[19])
-                wget_args.append(args[20])
-                wget_args.append(args[21])
-                wget_args.append(args[22])
-                wget_args.append(args[23])
-                wget_args.append(args[24])
-                wget_args.append(args[25])
-                wget_args.append(args[26])
-                wget_args.append(args[27])
-                wget_args.append(args[28])
-                wget_args.append(args[29])
-                wget_args.append(args[30])
-                wget_args.append(args[31])
-                wget_args.append(args[32])
-                wget_args.append(args[33])
-                wget_args.append(args[34])
-                wget_args.append(args[35])
-            
-        elif item_type == 'bellatlantic1296pack':
-            suffixes = string.digits + string.lowercase
-
-            for args in [('http://members.bellatlantic.net/{0}0{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}1{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}2{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}3{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}4{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}5{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}6{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}7{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}8{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}9{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}a{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}b{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}c{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}d{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}e{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}f{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}g{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}h{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}i{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}j{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}k{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}l{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}m{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}n{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}o{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}p{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}q{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}r{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}s{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}t{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}u{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}v{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}w{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}x{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}y{1}/'.format(item_value, s), \
-                          'http://members.bellatlantic.net/{0}z{1}/'.format(item_value, s)) for s in suffixes]:
-                wget_args.append(args[0])
-                wget_args.append(args[1])
-                wget_args.append(args[2])
-                wget_args.append(args[3])
-                wget_args.append(args[4])
-                wget_args.append(args[5])
-                wget_args.append(args[6])
-                wget_args.append(args[7])
-                wget_args.append(args[8])
-                wget_args.append(args[9])
-                wget_args.append(args[10])
-                wget_args.append(args[11])
-                wget_args.append(args[12])
-                wget_args.append(args[13])
-                wget_args.append(args[14])
-                wget_args.append(args[15])
-                wget_args.append(args[16])
-                wget_args.append(args[17])
-                wget_args.append(args[18])
-                wget_args.append(args[19])
-                wget_args.append(args[20])
-                wget_args.append(args[21])
-                wget_args.append(args[22])
-                wget_args.append(args[23])
-                wget_args.append(args[24])
-                wget_args.append(args[25])
-                wget_args.append(args[26])
-                wget_args.append(args[27])
-                wget_args.append(args[28])
-                wget_args.append(args[29])
-                wget_args.append(args[30])
-                wget_args.append(args[31])
-                wget_args.append(args[32])
-                wget_args.append(args[33])
-                wget_args.append(args[34])
-                wget_args.append(args[35])
-            
-        else:
-            raise Exception('Unknown item')
-        
-        if 'bind_address' in globals():
-            wget_args.extend(['--bind-address', globals()['bind_address']])
-            print('')
-            print('*** Wget will bind address at {0} ***'.format(
-                globals()['bind_address']))
-            print('')
+
+        if realize(DEDUP_ENTRIES) > 0:
+            wget_args.append("--warc-cdx")
+
+            if DEDUP_INDEX.has_entries():
+                wget_args.extend(["--warc-dedup", DEDUP_INDEX.filename])
+
+        if item['bind_address']:
+            wget_args.extend(['--bind-address', item['bind_address']])
+
+        return wget_args
+
+
+class RetryWgetArgs(WgetArgs):
+    def realize(self, item):
+        wget_args = self.common_args(item, RETRY_SUFFIX)
+        wget_args.extend([
+            "--warc-file", ItemInterpolation(
+                "%(item_dir)s/%(warc_file_base)s" + RETRY_SUFFIX),
+            "--input-file", ItemInterpolation("%(item_dir)s/retry-urls.txt"),
+        ])
 
         return realize(wget_args, item)
 
+
+# Used for the files of the Wget+Lua process that retries the URLs that
+# were put aside.
+RETRY_SUFFIX = '-retry'
+
+# Used for the grant FIFOs of the threads of CheckStartURLs, followed by
+# the number of the thread.
+PROBE_SUFFIX = '-probe'
+
+
+def shard_suffix(shard, shards):
+    if shards > 1:
+        return '-shard{0}'.format(shard)
+    else:
+        return ''
+
+
+# Wget+Lua writes its WARC in segments, a new one each time it starts, to
+# a checkpoint directory that is kept when the item fails. When Wget+Lua
+# is started again for the same item (a retry, or the item coming back
+# after a crash), the segments are cut back to their last complete record,
+# Wget+Lua skips the URLs that are in them, and it carries on with the URLs
+# that it had found but not fetched. Checkpoints that have not been
+# touched for CHECKPOINT_MAX_AGE seconds are removed.
+CHECKPOINT_DIR = os.path.join(CWD, 'data', 'checkpoints')
+CHECKPOINT_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def checkpoint_args(item, suffix, start_urls):
+    '''Returns the --warc-file argument for the next segment, and the
+    --input-file argument with the URLs to start with.'''
+    segments = checkpoint_segments(item, suffix)
+
+    if segments:
+        next_segment = segment_number(segments[-1]) + 1
+    else:
+        next_segment = 0
+
+    wget_args = ["--warc-file", "%s/segment%s.%d" % (item['checkpoint_dir'],
+        suffix, next_segment)]
+
+    if not segments:
+        # Whatever an earlier run noted down went with its segments.
+        for name in ('done', 'queued'):
+            if os.path.exists(checkpoint_file(item, name, suffix)):
+                os.remove(checkpoint_file(item, name, suffix))
+
+        with open("%s/urls%s.txt" % (item['item_dir'], suffix), 'w') as f:
+            for url in start_urls:
+                f.write(url + '\n')
+
+        return wget_args + ["--input-file",
+            "%s/urls%s.txt" % (item['item_dir'], suffix)]
+
+    done = set()
+    for filename in segments:
+        done.update(truncate_warc(filename))
+
+    with open(checkpoint_file(item, 'done', suffix), 'w') as f:
+        for url in done:
+            f.write(url + '\n')
+
+    urls = []
+    seen = set(done)
+    candidates = list(start_urls)
+
+    if os.path.exists(checkpoint_file(item, 'queued', suffix)):
+        with open(checkpoint_file(item, 'queued', suffix)) as f:
+            candidates.extend(line.strip() for line in f)
+
+    for url in candidates:
+        if url and url not in seen:
+            seen.add(url)
+            urls.append(url)
+
+    item.log_output("Resuming from %d WARC segments: %d URLs done, "
+        "%d to go.\n" % (len(segments), len(done), len(urls)))
+
+    if not urls:
+        # Wget needs something to start with. Everything it finds from
+        # here has been done already.
+        urls = start_urls
+
+    with open(checkpoint_file(item, 'resume', suffix), 'w') as f:
+        for url in urls:
+            f.write(url + '\n')
+
+    return wget_args + ["--input-file",
+        checkpoint_file(item, 'resume', suffix)]
+
+
+def checkpoint_segments(item, suffix):
+    return sorted(glob.glob("%s/segment%s.*.warc.gz" % (
+        item['checkpoint_dir'], suffix)), key=segment_number)
+
+
+def segment_number(filename):
+    return int(filename.rsplit('.', 3)[-3])
+
+
+def checkpoint_file(item, name, suffix):
+    return "%s/%s%s.txt" % (item['checkpoint_dir'], name, suffix)
+
+
+def remove_stale_checkpoints():
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return
+
+    for name in os.listdir(CHECKPOINT_DIR):
+        dirname = os.path.join(CHECKPOINT_DIR, name)
+
+        if os.path.getmtime(dirname) + CHECKPOINT_MAX_AGE < time.time():
+            shutil.rmtree(dirname, ignore_errors=True)
+
+
+class CollectWarcSegments(SimpleTask):
+    '''Lists the WARC segments that Wget+Lua wrote to the checkpoint
+    directory in item["warc_parts"], in the order they were written.'''
+    def __init__(self):
+        SimpleTask.__init__(self, "CollectWarcSegments")
+
+    def process(self, item):
+        if glob.glob("%(checkpoint_dir)s/segment*.warc" % item):
+            raise Exception('Please compile wget with zlib support!')
+
+        for shard in range(item["wget_shards"]):
+            item["warc_parts"].extend(checkpoint_segments(item,
+                shard_suffix(shard, item["wget_shards"])))
+
+
+class WgetDownloadShards(Task):
+    '''Runs one Wget+Lua process per shard of a pack item.
+
+    Every shard writes its own log and WARC segments. CollectWarcSegments
+    lists the segments for MergeWarcFiles once all shards have finished.
+    '''
+    def __init__(self, args, max_tries=1, retry_delay=30,
+                 accept_on_exit_code=[0], env=None):
+        Task.__init__(self, "WgetDownloadShards")
+        self.args = args
+        self.max_tries = max_tries
+        self.retry_delay = retry_delay
+        self.accept_on_exit_code = accept_on_exit_code
+        self.env = env
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+        item["shards_running"] = item["wget_shards"]
+        item["shards_failed"] = 0
+
+        for shard in range(item["wget_shards"]):
+            self.process(item, shard, 0)
+
+    def process(self, item, shard, tries):
+        with self.task_cwd():
+            env = realize(self.env, item)
+            env["shard_suffix"] = shard_suffix(shard, item["wget_shards"])
+
+            p = AsyncPopen(
+                args=self.args.realize_shard(item, shard, item["wget_shards"]),
+                env=env,
+                stdin=subprocess.PIPE,
+                close_fds=True
+            )
+
+            p.on_output += functools.partial(self.on_subprocess_stdout, item)
+            p.on_end += functools.partial(self.on_subprocess_end, item, shard,
+                tries)
+
+            p.run()
+
+            p.stdin.close()
+
+    def on_subprocess_stdout(self, item, data):
+        item.log_output(data, full_line=False)
+
+    def on_subprocess_end(self, item, shard, tries, returncode):
+        if returncode not in self.accept_on_exit_code:
+            tries += 1
+            item.log_output("Shard %d of %s returned exit code %d\n" % (
+                shard, item.description(), returncode))
+            item.log_error(self, returncode)
+
+            if tries < self.max_tries:
+                item.log_output("Retrying shard %d after %d seconds...\n" % (
+                    shard, self.retry_delay))
+                IOLoop.instance().add_timeout(
+                    datetime.timedelta(seconds=self.retry_delay),
+                    functools.partial(self.process, item, shard, tries))
+                return
+
+            item["shards_failed"] += 1
+
+        item["shards_running"] -= 1
+
+        if item["shards_running"] > 0:
+            return
+
+        if item["shards_failed"] > 0:
+            item.log_output("Failed %s for %s\n" % (self, item.description()))
+            self.fail_item(item)
+        else:
+            item.log_output("Finished %s for %s\n" % (self, item.description()))
+            self.complete_item(item)
+
+
 ###########################################################################
 # Initialize the project.
 #
@@ -455,22 +2411,141 @@ project = Project(
     utc_deadline=datetime.datetime(2014, 9, 30, 23, 59, 0)
 )
 
+wget_env = {
+    "item_dir": ItemValue("item_dir"),
+    "item_value": ItemValue("item_value"),
+    "item_type": ItemValue("item_type"),
+    "item_host": ItemValue("item_host"),
+    "item_suffix_length": ItemValue("item_suffix_length"),
+    "item_alphabet": ITEM_ALPHABET,
+    "rate_limiter": RATE_LIMITER.request_fifo,
+    "checkpoint_dir": ItemValue("checkpoint_dir"),
+    "downloader": downloader
+}
+
+if 'http_proxy' in globals():
+    # Only used to run against the stand-ins in util/benchmark/.
+    wget_env["http_proxy"] = http_proxy
+
+if 'url_log' in globals():
+    # Every URL Wget+Lua gets, for debugging; see the README.
+    wget_env["url_log"] = os.path.join(CWD, 'data', 'url-logs')
+
+    if not os.path.isdir(wget_env["url_log"]):
+        os.makedirs(wget_env["url_log"])
+
+if 'failure_server' in globals():
+    wget_env["failure_spool"] = os.path.join(CWD, 'data', 'failure-spool.tsv')
+
+    failure_reporter = FailureReporter(
+        server_url=failure_server.rstrip('/'),
+        spool_file=wget_env["failure_spool"],
+        batch_size=FAILURE_BATCH_SIZE,
+        interval=FAILURE_SPOOL_INTERVAL
+    )
+
+ip_checker = IPChecker(
+    hostnames=CHECK_IP_HOSTNAMES,
+    ttl=CHECK_IP_TTL,
+    timeout=CHECK_IP_TIMEOUT
+)
+
+admission_control = AdmissionControl(
+    directory=os.path.join(CWD, 'data'),
+    max_mb=MAX_IN_FLIGHT_MB,
+    min_free_mb=MIN_FREE_DISK_MB,
+    default_mb=ADMISSION_DEFAULT_MB,
+    smoothing=ADMISSION_SMOOTHING
+)
+
+tracker_prefetcher = TrackerPrefetcher(
+    tracker_url="http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+    size=PREFETCH_ITEMS,
+    lease=PREFETCH_LEASE,
+    paused=admission_control.disk_low
+)
+
+DEDUP_INDEX = DedupIndex(
+    filename=os.path.join(CWD, 'data', 'dedup', 'index.cdx'),
+    size=DEDUP_ENTRIES
+)
+
+batch_uploader = BatchUploader(
+    tracker_url="http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+    spool_dir=os.path.join(CWD, 'data', 'batch-upload'),
+    size_mb=BATCH_UPLOAD_MB,
+    max_age=BATCH_UPLOAD_MAX_AGE,
+    dedup_index=DEDUP_INDEX
+)
+
+RSYNC_THREADS = NumberConfigValue(min=1, max=4, default="1",
+    name="shared:rsync_threads", title="Rsync threads",
+    description="The maximum number of concurrent uploads.")
+
+
+def upload_with_tracker(files):
+    # Recompressed WARCs are uploaded with their CDX, so there are two of
+    # these in the pipeline.
+    return UploadWithTracker(
+        "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+        downloader=downloader,
+        version=VERSION,
+        files=files,
+        rsync_target_source_path=ItemInterpolation("%(data_dir)s/"),
+        rsync_extra_args=[
+            "--recursive",
+            "--partial",
+            "--partial-dir", ".rsync-tmp",
+        ]
+    )
+
+retry_env = dict(wget_env, shard_suffix=RETRY_SUFFIX, retry_pass="1")
+
 pipeline = Pipeline(
-    CheckIP(),
-    GetItemFromTracker("http://%s/%s" % (TRACKER_HOST, TRACKER_ID), downloader,
-        VERSION),
+    CheckIP(ip_checker),
+    WaitForAdmission("WaitForDiskSpace", admission_control.may_claim,
+        may_be_canceled=True),
+    ConditionalTask(lambda item: not use_prefetcher(item), GetItemFromTracker(
+        "http://%s/%s" % (TRACKER_HOST, TRACKER_ID), downloader, VERSION)),
+    ConditionalTask(use_prefetcher, GetItemFromPrefetcher(tracker_prefetcher,
+        GetItemFromTracker("http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
+            downloader, VERSION))),
     PrepareDirectories(warc_prefix="verizon"),
-    WgetDownload(
+    CheckStartURLs(threads=8),
+    WaitForAdmission("WaitForRoom", admission_control.admit),
+    ConditionalTask(lambda item: item["wget_shards"] == 1, WgetDownload(
         WgetArgs(),
         max_tries=2,
         accept_on_exit_code=[0, 4, 7, 8],
-        env={
-            "item_dir": ItemValue("item_dir"),
-            "item_value": ItemValue("item_value"),
-            "item_type": ItemValue("item_type"),
-            "downloader": downloader
-        }
-    ),
+        env=wget_env
+    )),
+    ConditionalTask(lambda item: item["wget_shards"] > 1, WgetDownloadShards(
+        WgetArgs(),
+        max_tries=2,
+        accept_on_exit_code=[0, 4, 7, 8],
+        env=wget_env
+    )),
+    CollectWarcSegments(),
+    CollectDeferredURLs(),
+    ConditionalTask(lambda item: item["deferred_urls"] > 0, WgetDownload(
+        RetryWgetArgs(),
+        max_tries=2,
+        accept_on_exit_code=[0, 4, 7, 8],
+        env=retry_env
+    )),
+    CollectWgetStats(),
+    ConditionalTask(lambda item: realize(DEDUP_ENTRIES, item) > 0,
+        CollectDedupEntries()),
+    MergeWarcFiles(),
+    ConditionalTask(use_recompression, LimitConcurrent(RECOMPRESS_PROCESSES,
+        ExternalProcess("RecompressWarc", [
+            sys.executable,
+            "recompress-warc.py",
+            ItemInterpolation("%(recompress_level)d"),
+            ItemInterpolation("%(item_dir)s/%(warc_file_base)s.warc.gz"),
+            ItemInterpolation("%(item_dir)s/%(warc_file_base)s.cdx")
+        ]))),
+    VerifyWarc(),
     PrepareStatsForTracker(
         defaults={"downloader": downloader, "version": VERSION},
         file_groups={
@@ -481,26 +2556,29 @@ pipeline = Pipeline(
         id_function=stats_id_function,
     ),
     MoveFiles(),
-    LimitConcurrent(NumberConfigValue(min=1, max=4, default="1",
-        name="shared:rsync_threads", title="Rsync threads",
-        description="The maximum number of concurrent uploads."),
-        UploadWithTracker(
-            "http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
-            downloader=downloader,
-            version=VERSION,
-            files=[
-                ItemInterpolation("%(data_dir)s/%(warc_file_base)s.warc.gz")
-            ],
-            rsync_target_source_path=ItemInterpolation("%(data_dir)s/"),
-            rsync_extra_args=[
-                "--recursive",
-                "--partial",
-                "--partial-dir", ".rsync-tmp",
-            ]
-            ),
-    ),
-    SendDoneToTracker(
+    ConditionalTask(
+        lambda item: not use_batch_upload(item) and not use_recompression(item),
+        LimitConcurrent(RSYNC_THREADS, upload_with_tracker([
+            ItemInterpolation("%(data_dir)s/%(warc_file_base)s.warc.gz")
+        ]))),
+    ConditionalTask(
+        lambda item: not use_batch_upload(item) and use_recompression(item),
+        LimitConcurrent(RSYNC_THREADS, upload_with_tracker([
+            ItemInterpolation("%(data_dir)s/%(warc_file_base)s.warc.gz"),
+            ItemInterpolation("%(data_dir)s/%(warc_file_base)s.cdx")
+        ]))),
+    ConditionalTask(use_batch_upload, QueueForBatchUpload(batch_uploader)),
+    ConditionalTask(lambda item: not use_batch_upload(item), SendDoneToTracker(
         tracker_url="http://%s/%s" % (TRACKER_HOST, TRACKER_ID),
         stats=ItemValue("stats")
-    )
+    )),
+    ConditionalTask(
+        lambda item: use_dedup_index(item) and not use_batch_upload(item),
+        UpdateDedupIndex(DEDUP_INDEX))
 )
+
+pipeline_metrics = PipelineMetrics(METRICS_LOG)
+pipeline_metrics.watch(pipeline)
+
+if METRICS_PORT:
+    pipeline_metrics.listen(METRICS_PORT)
@@ -0,0 +1,221 @@
+'''Recompresses a .warc.gz at another gzip level and writes a CDX index
+for it, in one pass. The pipeline runs this after an item's WARC parts
+have been merged, when recompress_level is set.
+
+Every gzip member (Wget writes one for each record) is recompressed on
+its own, so the result is still a record-at-a-time .warc.gz. Each new
+member is decompressed again and compared with the original before it is
+kept. The WARC is only replaced when all members came through unchanged.
+
+    python recompress-warc.py LEVEL FILE.warc.gz FILE.cdx
+'''
+import functools
+import hashlib
+import os
+import sys
+import urlparse
+import zlib
+
+
+CHUNK_SIZE = 65536
+HEAD_SIZE = 65536
+CDX_HEADER = ' CDX N b a m s k r M S V g\n'
+
+
+class MemberWriter(object):
+    '''Compresses one gzip member and checks that it decompresses to what
+    went in.'''
+    def __init__(self, out_file, level):
+        self.out_file = out_file
+        self.size = 0
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._original = hashlib.sha1()
+        self._roundtrip = hashlib.sha1()
+
+    def write(self, data):
+        self._original.update(data)
+        self._output(self._compressor.compress(data))
+
+    def close(self):
+        self._output(self._compressor.flush())
+        self._roundtrip.update(self._decompressor.flush())
+
+        if self._original.digest() != self._roundtrip.digest():
+            raise Exception('A recompressed record does not match the '
+                'original.')
+
+    def _output(self, data):
+        self._roundtrip.update(self._decompressor.decompress(data))
+        self.out_file.write(data)
+        self.size += len(data)
+
+
+def recompress(in_filename, out_filename, level):
+    '''Writes the recompressed WARC to out_filename and returns a CDX line
+    for every response and revisit record.'''
+    cdx_lines = []
+    warc_name = os.path.basename(in_filename)
+    decompressor = None
+    writer = None
+    head = ''
+    offset = 0
+
+    with open(in_filename, 'rb') as in_file, \
+            open(out_filename, 'wb') as out_file:
+        for data in iter(functools.partial(in_file.read, CHUNK_SIZE), ''):
+            while data:
+                if decompressor is None:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    writer = MemberWriter(out_file, level)
+                    head = ''
+
+                record_data = decompressor.decompress(data)
+                writer.write(record_data)
+                if len(head) < HEAD_SIZE:
+                    head += record_data[:HEAD_SIZE - len(head)]
+
+                # Whatever follows the end of a member starts the next one.
+                data = decompressor.unused_data
+                if data:
+                    writer.close()
+                    add_cdx_line(cdx_lines, head, offset, writer.size,
+                        warc_name)
+                    offset += writer.size
+                    decompressor = None
+
+        if decompressor is not None:
+            if not gzip_member_finished(decompressor):
+                raise Exception('%s ends in the middle of a gzip member.'
+                    % in_filename)
+
+            writer.close()
+            add_cdx_line(cdx_lines, head, offset, writer.size, warc_name)
+
+    return cdx_lines
+
+
+def gzip_member_finished(decompressor):
+    # Python 2 has no decompressobj.eof, but a finished stream passes any
+    # further input through to unused_data.
+    try:
+        decompressor.decompress('\x01')
+    except zlib.error:
+        return False
+
+    return decompressor.unused_data == '\x01'
+
+
+def add_cdx_line(cdx_lines, head, offset, size, warc_name):
+    record = parse_record_head(head)
+
+    if record is None:
+        return
+
+    cdx_lines.append(' '.join([
+        surt(record['uri']),
+        record['date'],
+        record['uri'],
+        record['mime'],
+        record['status'],
+        record['digest'],
+        record['redirect'],
+        '-',
+        str(size),
+        str(offset),
+        warc_name,
+    ]) + '\n')
+
+
+def parse_record_head(head):
+    '''Returns the CDX fields of a response or revisit record from the
+    start of its data, or None for the other records.'''
+    warc_header, dummy, block = head.partition('\r\n\r\n')
+    fields = header_fields(warc_header)
+    warc_type = fields.get('warc-type')
+
+    if warc_type not in ('response', 'revisit') or \
+            'warc-target-uri' not in fields:
+        return None
+
+    http_header, dummy, body = block.partition('\r\n\r\n')
+    http_fields = header_fields(http_header)
+    status_line = http_header.split('\r\n', 1)[0].split()
+    status = '-'
+    if len(status_line) > 1 and status_line[1].isdigit():
+        status = status_line[1]
+
+    if warc_type == 'revisit':
+        mime = 'warc/revisit'
+    else:
+        mime = http_fields.get('content-type', '').split(';')[0].strip() or '-'
+
+    return {
+        'uri': cdx_field(fields['warc-target-uri'].strip('<>')),
+        'date': ''.join(c for c in fields.get('warc-date', '')
+            if c.isdigit())[:14] or '-',
+        'mime': cdx_field(mime),
+        'status': status,
+        'digest': cdx_field(
+            fields.get('warc-payload-digest', '-').split(':')[-1]),
+        'redirect': cdx_field(http_fields.get('location', '-')),
+    }
+
+
+def header_fields(header):
+    fields = {}
+    for line in header.split('\r\n')[1:]:
+        name, dummy, value = line.partition(':')
+        fields[name.strip().lower()] = value.strip()
+
+    return fields
+
+
+def cdx_field(value):
+    return value.replace(' ', '%20') or '-'
+
+
+def surt(uri):
+    '''The sort key of a URL in a CDX: the host turned around, without
+    "www." and the scheme, so that http://www.Example.com/a becomes
+    com,example)/a.'''
+    url = urlparse.urlsplit(uri.lower())
+    host = url.hostname or ''
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+
+    key = ','.join(reversed(host.split('.')))
+    if url.port and url.port != {'http': 80, 'https': 443}.get(url.scheme):
+        key += ':%d' % url.port
+
+    key += ')' + (url.path or '/')
+    if url.query:
+        key += '?' + url.query
+
+    return key
+
+
+def main():
+    level, warc_filename, cdx_filename = sys.argv[1:]
+    level = int(level)
+    tmp_filename = warc_filename + '.tmp'
+
+    old_size = os.path.getsize(warc_filename)
+    cdx_lines = recompress(warc_filename, tmp_filename, level)
+    cdx_lines.sort()
+
+    with open(cdx_filename + '.tmp', 'w') as out_file:
+        out_file.write(CDX_HEADER)
+        out_file.writelines(cdx_lines)
+
+    new_size = os.path.getsize(tmp_filename)
+    os.rename(tmp_filename, warc_filename)
+    os.rename(cdx_filename + '.tmp', cdx_filename)
+
+    print('Recompressed at level %d: %d -> %d bytes, %d CDX lines.'
+        % (level, old_size, new_size, len(cdx_lines)))
+
+
+if __name__ == '__main__':
+    main()
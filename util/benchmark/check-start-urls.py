@@ -0,0 +1,108 @@
+'''Runs CheckStartURLs for a pack item against the site stand-in of
+standins.py, where some of the homepages redirect to the landing page the
+way missing ones do, and checks that:
+
+* the live list holds exactly the homepages that exist,
+* the probe WARC has a request and a response record for each missing
+  homepage and nothing else,
+* the requests went through the rate limiter, one at a time per token.
+
+Needs wget-lua (as for the real pipeline), but no network. Run it from
+the repository root:
+
+    python util/benchmark/check-start-urls.py verizon36pack:ab
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tornado.ioloop import IOLoop
+
+from seesaw.item import Item
+from seesaw.pipeline import Pipeline
+
+from standins import SiteConfig, SiteServer
+
+
+def expected_live(context, config, item_name):
+    item_type, item_value = item_name.split(':', 1)
+    host = context['ITEM_TYPES'][item_type][0]
+
+    return [url for url in context['start_urls'](item_type, item_value)
+        if config.chance(host, url.split('/')[3]) >= config.missing_ratio]
+
+
+def run(context, item_name, data_dir):
+    pipeline = Pipeline(
+        context['PrepareDirectories'](warc_prefix='verizon'),
+        context['CheckStartURLs'](threads=8))
+    pipeline.data_dir = data_dir
+    item = Item(pipeline, 'check-start-urls', 1, keep_data=True)
+    item['item_name'] = item_name
+    item.on_finish += lambda item: IOLoop.instance().stop()
+
+    started = time.time()
+    pipeline.enqueue(item)
+    IOLoop.instance().start()
+
+    return (item, time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check CheckStartURLs against the site stand-in.')
+    parser.add_argument('item_name', nargs='?', default='verizon36pack:ab')
+    parser.add_argument('--missing-ratio', type=float, default=0.5)
+    args = parser.parse_args()
+
+    if not os.path.exists('pipeline.py'):
+        sys.exit('Run this from the repository root.')
+
+    config = SiteConfig(missing_ratio=args.missing_ratio)
+    site = SiteServer(config).start()
+    context = {'downloader': 'benchmark', 'http_proxy': site.proxy_url}
+    with open('pipeline.py') as f:
+        exec f.read() in context, context
+
+    data_dir = tempfile.mkdtemp(prefix='verizon-benchmark-start-urls-')
+    try:
+        (item, seconds) = run(context, args.item_name, data_dir)
+        start_urls = list(context['start_urls'](
+            *args.item_name.split(':', 1)))
+        live = expected_live(context, config, args.item_name)
+        missing = set(start_urls) - set(live)
+        info = context['scan_warc'](item['warc_parts'][0], collect_uris=True)
+    finally:
+        if 'checkpoint_dir' in item:
+            shutil.rmtree(item['checkpoint_dir'], ignore_errors=True)
+        shutil.rmtree(data_dir)
+
+    # Every token after the first burst costs at least 1 / RATE_LIMIT_MAX.
+    min_seconds = (len(start_urls) - context['RATE_LIMIT_BURST']) \
+        / context['RATE_LIMIT_MAX']
+
+    checks = [
+        ('item completed', item.completed),
+        ('live homepages', sorted(item['start_urls']) == sorted(live)),
+        ('probe WARC records', info['records'] == {
+            'request': len(missing), 'response': len(missing)}),
+        ('probe WARC URLs', sorted(info['target_uris']) == sorted(missing)),
+        ('one request per start URL', site.requests == len(start_urls)),
+        ('paced by the rate limiter', seconds >= min_seconds),
+    ]
+
+    print('%d start URLs, %d live, %d missing, %.1f seconds.' % (
+        len(start_urls), len(live), len(missing), seconds))
+    for (name, passed) in checks:
+        print('%-28s %s' % (name, 'ok' if passed else 'FAILED'))
+
+    # Skip waiting for the pipeline's threads.
+    sys.stdout.flush()
+    os._exit(0 if all(passed for (name, passed) in checks) else 1)
+
+
+if __name__ == '__main__':
+    main()
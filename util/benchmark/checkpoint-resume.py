@@ -0,0 +1,165 @@
+'''Checks resuming an item from its checkpoint: writes a WARC segment the
+way Wget+Lua does and cuts it off in the middle of a record, the way it is
+left when Wget+Lua is killed. Then checks that:
+
+* checkpoint_args cuts the segment back to its last complete record, and
+  resumes with the start URLs and queued URLs that are not in it,
+* after the remaining URLs are written to the next segment, the WARC that
+  CollectWarcSegments and MergeWarcFiles make of the segments holds every
+  URL exactly once.
+
+This is done for a cut in the request record, right after it and in the
+response record.
+
+Needs wget-lua (as for the real pipeline), but no network. Run it from
+the repository root:
+
+    python util/benchmark/checkpoint-resume.py
+'''
+import os
+import shutil
+import sys
+import tempfile
+
+
+START_URLS = ['http://mysite.verizon.net/user%d/' % number
+    for number in range(8)]
+QUEUED_URLS = ['http://mysite.verizon.net/user%d/page.html' % number
+    for number in range(4)]
+DONE = 5
+
+# Where the segment is cut, within the records of the URL after the last
+# one that was done: (record, share of the record's gzip member).
+CUTS = [
+    ('in the request', 0, 0.5),
+    ('after the request', 1, 0.0),
+    ('in the response', 1, 0.5),
+]
+
+
+class StubItem(dict):
+    def log_output(self, data):
+        pass
+
+
+def make_item(context, work_dir, name):
+    item = StubItem(item_dir=os.path.join(work_dir, name),
+        checkpoint_dir=os.path.join(work_dir, name, 'checkpoint'),
+        warc_file_base='checkpoint-resume', warc_parts=[], wget_shards=1)
+    os.makedirs(item['checkpoint_dir'])
+
+    return item
+
+
+def warc_file_arg(wget_args):
+    return wget_args[wget_args.index('--warc-file') + 1] + '.warc.gz'
+
+
+def input_file_urls(wget_args):
+    with open(wget_args[wget_args.index('--input-file') + 1]) as f:
+        return [line.strip() for line in f]
+
+
+def write_records(context, filename, urls):
+    with open(filename, 'ab') as warc_file:
+        for url in urls:
+            context['write_warc_records'](warc_file, url,
+                'GET %s HTTP/1.0\r\n\r\n' % url,
+                'HTTP/1.0 200 OK\r\n\r\n<html>%s</html>' % url)
+
+
+def member_sizes(context, url):
+    '''Returns the sizes of the gzip members of the request and response
+    records for url.'''
+    filename = tempfile.mktemp(suffix='.warc.gz')
+    write_records(context, filename, [url])
+
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    finally:
+        os.remove(filename)
+
+    # Every member starts with the gzip magic and the deflate method.
+    second = data.index('\x1f\x8b\x08', 1)
+
+    return (second, len(data) - second)
+
+
+def check_cut(context, item, record, share):
+    # The first run: a fresh segment, killed partway.
+    wget_args = context['checkpoint_args'](item, '', START_URLS)
+    segment = warc_file_arg(wget_args)
+    assert input_file_urls(wget_args) == START_URLS, input_file_urls(wget_args)
+
+    write_records(context, segment, START_URLS[:DONE])
+    whole_size = os.path.getsize(segment)
+    write_records(context, segment, START_URLS[DONE:DONE + 1])
+    sizes = member_sizes(context, START_URLS[DONE])
+    with open(segment, 'r+b') as f:
+        f.truncate(whole_size + sum(sizes[:record])
+            + int(sizes[record] * share))
+
+    with open(context['checkpoint_file'](item, 'queued', ''), 'w') as f:
+        for url in START_URLS[:2] + QUEUED_URLS:
+            f.write(url + '\n')
+
+    # The second run.
+    wget_args = context['checkpoint_args'](item, '', START_URLS)
+    assert os.path.getsize(segment) == whole_size, \
+        'the segment was cut to %d bytes, not %d' % (
+            os.path.getsize(segment), whole_size)
+    info = context['scan_warc'](segment, collect_uris=True)
+    assert info['target_uris'] == START_URLS[:DONE], info['target_uris']
+
+    resume = input_file_urls(wget_args)
+    assert resume == START_URLS[DONE:] + QUEUED_URLS, resume
+    assert warc_file_arg(wget_args) != segment
+
+    write_records(context, warc_file_arg(wget_args), resume)
+
+    # What the pipeline does once Wget+Lua is done.
+    context['CollectWarcSegments']().process(item)
+    context['MergeWarcFiles']().process(item)
+    info = context['scan_warc']('%(item_dir)s/%(warc_file_base)s.warc.gz'
+        % item, collect_uris=True)
+
+    expected = START_URLS + QUEUED_URLS
+    assert sorted(info['target_uris']) == sorted(expected), \
+        info['target_uris']
+    assert info['records'] == {'request': len(expected),
+        'response': len(expected)}, info['records']
+
+
+def main():
+    if not os.path.exists('pipeline.py'):
+        sys.exit('Run this from the repository root.')
+
+    context = {'downloader': 'benchmark'}
+    with open('pipeline.py') as f:
+        exec f.read() in context, context
+
+    work_dir = tempfile.mkdtemp(prefix='verizon-benchmark-checkpoint-')
+    failed = 0
+
+    try:
+        for (number, (name, record, share)) in enumerate(CUTS):
+            item = make_item(context, work_dir, str(number))
+
+            try:
+                check_cut(context, item, record, share)
+            except AssertionError as error:
+                failed += 1
+                print('cut %-24s FAILED %s' % (name, error))
+            else:
+                print('cut %-24s ok' % name)
+    finally:
+        shutil.rmtree(work_dir)
+
+    # Skip waiting for the pipeline's threads.
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
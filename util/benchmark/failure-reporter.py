@@ -0,0 +1,151 @@
+'''Checks the FailureReporter against the failure server stand-in of
+standins.py: that spooled failures are sent to /fail/bulk in batches and
+the spool is emptied, that lines that are cut off are dropped, and that
+failures that could not be sent during an outage (the server refusing
+connections, or answering with a 500 after the first batch) are sent
+once it is back, each exactly once and in order.
+
+Needs wget-lua (as for the real pipeline), but no network. Run it from
+the repository root:
+
+    python util/benchmark/failure-reporter.py
+'''
+import glob
+import os
+import shutil
+import socket
+import sys
+import tempfile
+
+from standins import FailureServer
+
+
+BATCH_SIZE = 3
+
+
+def spool(filename, failures, broken=False):
+    '''Appends failures to the spool file the way verizon.lua does.'''
+    with open(filename, 'a') as f:
+        for failure in failures:
+            f.write('\t'.join((failure['response_code'], failure['url'],
+                failure['downloader'], failure['item_name'])) + '\n')
+
+        if broken:
+            # A line the process did not get to finish.
+            f.write('404\thttp://mysite.verizon.net/cut')
+
+
+def make_failures(first, count):
+    return [{
+        'response_code': '404',
+        'url': 'http://mysite.verizon.net/user%d/' % number,
+        'downloader': 'benchmark',
+        'item_name': 'verizon:user%d' % number,
+    } for number in range(first, first + count)]
+
+
+def free_port():
+    '''A port that refuses connections, until a server is started on it.'''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    return port
+
+
+def reporter(context, work_dir, server_url):
+    spool_file = os.path.join(work_dir, 'failure-spool.tsv')
+    # A long interval, so that only flush() sends anything.
+    return context['FailureReporter'](server_url, spool_file, BATCH_SIZE,
+        interval=3600)
+
+
+def leftovers(reporter):
+    return glob.glob(reporter.spool_file + '*')
+
+
+def check_bulk(context, work_dir):
+    server = FailureServer().start()
+    failures = make_failures(0, 7)
+    failure_reporter = reporter(context, work_dir, server.url)
+
+    spool(failure_reporter.spool_file, failures, broken=True)
+    failure_reporter.flush()
+    server.shutdown()
+
+    assert server.failures == failures, server.failures
+    assert server.requests == [('/fail/bulk', 3), ('/fail/bulk', 3),
+        ('/fail/bulk', 1)], server.requests
+    assert not leftovers(failure_reporter), leftovers(failure_reporter)
+
+
+def check_refused(context, work_dir):
+    port = free_port()
+    failures = make_failures(0, 5)
+    failure_reporter = reporter(context, work_dir,
+        'http://127.0.0.1:%d' % port)
+
+    spool(failure_reporter.spool_file, failures[:4])
+    failure_reporter.flush()
+    assert len(leftovers(failure_reporter)) == 1, leftovers(failure_reporter)
+
+    # More failures come in during the outage.
+    spool(failure_reporter.spool_file, failures[4:])
+
+    server = FailureServer(port).start()
+    failure_reporter.flush()
+    server.shutdown()
+
+    assert server.failures == failures, server.failures
+    assert not leftovers(failure_reporter), leftovers(failure_reporter)
+
+
+def check_server_error(context, work_dir):
+    server = FailureServer(statuses=[200, 500]).start()
+    failures = make_failures(0, 8)
+    failure_reporter = reporter(context, work_dir, server.url)
+
+    spool(failure_reporter.spool_file, failures)
+    failure_reporter.flush()
+    assert server.failures == failures[:BATCH_SIZE], server.failures
+
+    failure_reporter.flush()
+    server.shutdown()
+
+    assert server.failures == failures, server.failures
+    assert not leftovers(failure_reporter), leftovers(failure_reporter)
+
+
+CHECKS = [check_bulk, check_refused, check_server_error]
+
+
+def main():
+    if not os.path.exists('pipeline.py'):
+        sys.exit('Run this from the repository root.')
+
+    context = {'downloader': 'benchmark'}
+    with open('pipeline.py') as f:
+        exec f.read() in context, context
+
+    failed = 0
+    for check in CHECKS:
+        work_dir = tempfile.mkdtemp(prefix='verizon-benchmark-failures-')
+
+        try:
+            check(context, work_dir)
+        except AssertionError as error:
+            failed += 1
+            print('%-28s FAILED %s' % (check.__name__, error))
+        else:
+            print('%-28s ok' % check.__name__)
+        finally:
+            shutil.rmtree(work_dir)
+
+    # Skip waiting for the pipeline's threads.
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
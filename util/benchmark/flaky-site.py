@@ -0,0 +1,68 @@
+'''Replays a flaky site: runs the real pipeline against the site stand-in
+of standins.py with a growing share of requests failing with a 503, and
+reports the wall time, and how many of the URLs in the end got a response
+that was not a server error (the success rate). The retries and deferred
+URLs come from the pipeline's metrics log.
+
+The host circuits and the retry pass in verizon.lua should keep the
+success rate close to 100% without the wall time growing much beyond what
+the retries themselves take.
+
+Needs wget-lua (as for the real pipeline), rsync and Linux, like
+run-benchmark.py, whose options it shares. Run it from the repository
+root:
+
+    python util/benchmark/flaky-site.py --error-ratios 0,0.05,0.2
+'''
+import imp
+import os
+import shutil
+import sys
+import tempfile
+
+
+benchmark = imp.load_source('run_benchmark',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'run-benchmark.py'))
+
+
+def main():
+    parser = benchmark.argument_parser(
+        'Benchmark the pipeline against a flaky site.')
+    parser.add_argument('--type', default='verizon36pack',
+        help='the item type (default: %(default)s)')
+    parser.add_argument('--error-ratios', default='0,0.05,0.2',
+        help='comma-separated shares of requests that fail '
+        '(default: %(default)s)')
+    args = parser.parse_args()
+
+    if not os.path.exists('pipeline.py'):
+        sys.exit('Run this from the repository root.')
+
+    work_dir = tempfile.mkdtemp(prefix='verizon-benchmark-flaky-')
+    results = []
+
+    try:
+        for error_ratio in args.error_ratios.split(','):
+            args.error_ratio = float(error_ratio)
+            result = benchmark.run_item_type(args, args.type, work_dir)
+            result['error_ratio'] = args.error_ratio
+            results.append(result)
+    finally:
+        if results and not any(result['failed'] for result in results):
+            shutil.rmtree(work_dir)
+        else:
+            print('Logs are in %s' % work_dir)
+
+    print('%-12s %6s %6s %9s %8s %10s %8s %9s' % ('error ratio', 'items',
+        'failed', 'seconds', 'URLs', 'success %', 'retries', 'deferred'))
+    for result in results:
+        print('%12.2f %6d %6d %9.1f %8d %10.1f %8d %9d' % (
+            result['error_ratio'], result['items'], result['failed'],
+            result['seconds'], result['site_urls'],
+            100 * result['success_rate'], result['retries'],
+            result['deferred']))
+
+
+if __name__ == '__main__':
+    main()
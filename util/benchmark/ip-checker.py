@@ -0,0 +1,176 @@
+'''Checks the IPChecker that CheckIP uses, with a stub resolver instead of
+DNS: that a name that does not resolve in time does not hold up the
+check, that nothing is looked up again within the TTL, that a stale
+result is refreshed in the background while CheckIP goes on with the old
+one, and that CheckIP fails items when the names share an address or any
+of them did not resolve.
+
+Needs wget-lua (as for the real pipeline), but no network. Run it from
+the repository root:
+
+    python util/benchmark/ip-checker.py
+'''
+import os
+import socket
+import sys
+import threading
+import time
+
+
+TIMEOUT = 0.5
+TTL = 1.5
+
+
+class StubResolver(object):
+    '''Gives each name its own address, after delay seconds. Names in
+    slow never answer in time and names in broken do not resolve.'''
+    def __init__(self, delay=0, slow=(), broken=(), address=None):
+        self.delay = delay
+        self.slow = slow
+        self.broken = broken
+        self.address = address
+        self.lookups = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, hostname):
+        with self._lock:
+            self.lookups += 1
+
+        time.sleep(self.delay)
+        if hostname in self.slow:
+            time.sleep(TIMEOUT * 10)
+        if hostname in self.broken:
+            raise socket.gaierror('Name or service not known')
+
+        return self.address or '10.0.0.%d' % (sum(map(ord, hostname)) % 250)
+
+
+class StubItem(dict):
+    def log_output(self, data):
+        pass
+
+
+def wait_for_check(checker):
+    deadline = time.time() + TIMEOUT * 4
+    while checker.addresses() is None and time.time() < deadline:
+        time.sleep(0.01)
+
+    return checker.addresses()
+
+
+def check_timeout(context):
+    resolver = StubResolver(slow=['slow.example'])
+    started = time.time()
+    checker = context['IPChecker'](['a.example', 'b.example', 'slow.example'],
+        TTL, TIMEOUT, resolver)
+    addresses = wait_for_check(checker)
+
+    assert sorted(addresses) == ['a.example', 'b.example'], addresses
+    assert time.time() - started < TIMEOUT * 2, time.time() - started
+
+    try:
+        context['CheckIP'](checker).process(StubItem())
+    except Exception:
+        return
+    raise AssertionError('A check without slow.example was let through.')
+
+
+def check_ttl(context):
+    resolver = StubResolver()
+    checker = context['IPChecker'](['a.example', 'b.example'], TTL, TIMEOUT,
+        resolver)
+    wait_for_check(checker)
+    task = context['CheckIP'](checker)
+
+    for i in range(100):
+        task.process(StubItem())
+    assert resolver.lookups == 2, resolver.lookups
+
+    time.sleep(TTL)
+    task.process(StubItem())
+    time.sleep(0.1)
+    assert resolver.lookups == 4, resolver.lookups
+
+
+def check_background_refresh(context):
+    resolver = StubResolver()
+    checker = context['IPChecker'](['a.example', 'b.example'], TTL, TIMEOUT,
+        resolver)
+    old = wait_for_check(checker)
+    resolver.delay = TIMEOUT / 2
+    time.sleep(TTL)
+
+    # The stale result comes back at once while the refresh runs.
+    started = time.time()
+    context['CheckIP'](checker).process(StubItem())
+    assert checker.addresses() == old
+    assert time.time() - started < resolver.delay / 2, time.time() - started
+
+    time.sleep(resolver.delay * 2)
+    assert resolver.lookups == 4, resolver.lookups
+
+
+def check_firewall(context):
+    checker = context['IPChecker'](['a.example', 'b.example'], TTL, TIMEOUT,
+        StubResolver(address='192.0.2.1'))
+    wait_for_check(checker)
+
+    try:
+        context['CheckIP'](checker).process(StubItem())
+    except Exception:
+        return
+    raise AssertionError('Shared addresses were let through.')
+
+
+def check_unresolved(context):
+    for broken in (['a.example'], ['a.example', 'b.example']):
+        resolver = StubResolver(broken=broken)
+        checker = context['IPChecker'](['a.example', 'b.example'], TTL,
+            TIMEOUT, resolver)
+        wait_for_check(checker)
+
+        try:
+            context['CheckIP'](checker).process(StubItem())
+        except Exception:
+            pass
+        else:
+            raise AssertionError('A check without %s was let through.'
+                % ', '.join(broken))
+
+    # Not kept, so DNS coming back is noticed right away.
+    resolver.broken = ()
+    time.sleep(0.1)
+    checker.addresses()
+    time.sleep(0.1)
+    assert len(checker.addresses()) == 2, checker.addresses()
+
+
+CHECKS = [check_timeout, check_ttl, check_background_refresh,
+    check_firewall, check_unresolved]
+
+
+def main():
+    if not os.path.exists('pipeline.py'):
+        sys.exit('Run this from the repository root.')
+
+    context = {'downloader': 'benchmark'}
+    with open('pipeline.py') as f:
+        exec f.read() in context, context
+
+    failed = 0
+    for check in CHECKS:
+        try:
+            check(context)
+        except AssertionError as error:
+            failed += 1
+            print('%-28s FAILED %s' % (check.__name__, error))
+        else:
+            print('%-28s ok' % check.__name__)
+
+    # Skip waiting for the pipeline's threads.
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
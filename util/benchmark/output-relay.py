@@ -0,0 +1,130 @@
+'''Measures how much CPU the pipeline process spends relaying the progress
+output of Wget+Lua, with one line for every URL (the old httploop_result)
+and with at most one line a second (the current one).
+
+It runs --items stand-ins for Wget+Lua at the same time, each getting
+--rate URLs a second for --seconds seconds, through seesaw's
+ExternalProcess, the runner's output handler and the web interface's
+ItemMonitor, which is the way the output of the real thing goes. It then
+reports the CPU time of this (the pipeline) process for each mode.
+
+Run it from the repository root, no network needed:
+
+    python util/benchmark/output-relay.py --items 6 --rate 500
+'''
+import argparse
+import os
+import resource
+import sys
+import time
+
+from tornado.ioloop import IOLoop
+
+from seesaw.externalprocess import ExternalProcess
+from seesaw.item import Item
+from seesaw.pipeline import Pipeline
+from seesaw.web import ItemMonitor
+
+
+MODES = ['per-url', 'throttled']
+
+
+def emit(mode, rate, seconds):
+    '''What verizon.lua writes to stdout, without downloading anything.'''
+    url_count = 0
+    progress_time = 0
+    started = time.time()
+
+    while time.time() - started < seconds:
+        for i in range(rate // 10):
+            url_count += 1
+            url = 'http://mysite.verizon.net/benchmark/page-%d.html' % url_count
+
+            if mode == 'per-url':
+                sys.stdout.write('%d=200 %s.  \r' % (url_count, url))
+                sys.stdout.flush()
+            elif int(time.time()) != progress_time:
+                progress_time = int(time.time())
+                sys.stdout.write('%d URLs, %.1f MB, 0 errors, now at '
+                    'mysite.verizon.net.  \r' % (url_count,
+                    url_count * 20000 / 1048576.0))
+                sys.stdout.flush()
+
+        time.sleep(0.1)
+
+    sys.stdout.write('\n')
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def relay(args, mode, devnull):
+    '''Runs the stand-ins through seesaw and returns the CPU seconds and
+    bytes of output of this process.'''
+    task = ExternalProcess('Emit', [sys.executable, __file__, '--emit', mode,
+        '--rate', str(args.rate), '--seconds', str(args.seconds)])
+    pipeline = Pipeline(task)
+    pipeline.data_dir = args.data_dir
+    running = set()
+    output = [0]
+
+    def handle_output(item, data):
+        # What the runner does with the output of an item
+        devnull.write(data)
+        output[0] += len(data)
+
+    def handle_finish(item):
+        running.discard(item)
+        if not running:
+            IOLoop.instance().stop()
+
+    for number in range(args.items):
+        item = Item(pipeline, 'relay-%s-%d' % (mode, number), number)
+        item['item_name'] = 'benchmark:%d' % number
+        item.on_output += handle_output
+        item.on_complete += handle_finish
+        item.on_fail += handle_finish
+        ItemMonitor(item)
+        running.add(item)
+
+    started = cpu_seconds()
+    for item in list(running):
+        pipeline.enqueue(item)
+    IOLoop.instance().start()
+
+    return (cpu_seconds() - started, output[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark relaying the progress output of Wget+Lua.')
+    parser.add_argument('--items', type=int, default=6,
+        help='concurrent items (default: %(default)s)')
+    parser.add_argument('--rate', type=int, default=500,
+        help='URLs a second for each item (default: %(default)s)')
+    parser.add_argument('--seconds', type=int, default=10,
+        help='how long each item runs (default: %(default)s)')
+    parser.add_argument('--data-dir', default='data/output-relay')
+    parser.add_argument('--emit', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.emit:
+        emit(args.emit, args.rate, args.seconds)
+        return
+
+    if not os.path.isdir(args.data_dir):
+        os.makedirs(args.data_dir)
+
+    print('%-10s %12s %14s %14s' % ('output', 'CPU seconds', 'CPU %',
+        'output bytes'))
+    with open(os.devnull, 'w') as devnull:
+        for mode in MODES:
+            (cpu, output) = relay(args, mode, devnull)
+            print('%-10s %12.2f %14.1f %14d' % (mode, cpu,
+                100 * cpu / args.seconds, output))
+
+
+if __name__ == '__main__':
+    main()
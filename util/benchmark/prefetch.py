@@ -0,0 +1,144 @@
+'''Measures how long items wait for a slow tracker, getting them from the
+tracker one at a time (GetItemFromTracker) and from the TrackerPrefetcher
+(prefetch_items), to check that prefetching hides the latency.
+
+It loads pipeline.py and runs its tasks for getting items against the fake
+tracker of standins.py, which takes --latency seconds to answer. Instead
+of downloading anything, every item then holds its slot for --work
+seconds. --concurrent slots take --items items in all.
+
+Needs wget-lua (as for the real pipeline), but no network. Run it from
+the repository root:
+
+    python util/benchmark/prefetch.py --latency 2 --work 5
+'''
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from tornado.ioloop import IOLoop
+
+from seesaw.item import Item
+from seesaw.pipeline import Pipeline
+from seesaw.task import Task
+
+from standins import TrackerServer
+
+
+class Hold(Task):
+    '''Stands in for the download: notes how long the item waited for the
+    tracker and keeps the slot busy for a while.'''
+    def __init__(self, seconds, waits):
+        Task.__init__(self, "Hold")
+        self.seconds = seconds
+        self.waits = waits
+
+    def enqueue(self, item):
+        self.start_item(item)
+        self.waits.append(time.time() - item['queued_at'])
+        IOLoop.instance().add_timeout(
+            datetime.timedelta(seconds=self.seconds),
+            lambda: self.complete_item(item))
+
+
+def run(args, context, mode, data_dir):
+    '''Runs the items through the pipeline's way of getting them and
+    returns the seconds each one waited and the seconds it all took.'''
+    tracker = TrackerServer(['verizon:prefetch%d' % number
+        for number in range(args.items)], 'rsync://127.0.0.1/none/',
+        latency=args.latency).start()
+    tracker_url = 'http://%s/verizon' % tracker.host
+
+    if mode == 'prefetch':
+        get_item = context['GetItemFromPrefetcher'](
+            context['TrackerPrefetcher'](tracker_url, size=args.prefetch,
+                lease=3600, paused=lambda: False),
+            context['GetItemFromTracker'](tracker_url, 'benchmark',
+                context['VERSION']))
+    else:
+        get_item = context['GetItemFromTracker'](tracker_url, 'benchmark',
+            context['VERSION'])
+
+    waits = []
+    pipeline = Pipeline(get_item, Hold(args.work, waits))
+    pipeline.data_dir = data_dir
+    numbers = iter(range(args.items))
+    running = set()
+
+    def start_next(finished=None):
+        running.discard(finished)
+
+        for number in numbers:
+            item = Item(pipeline, '%s-%d' % (mode, number), number)
+            item['queued_at'] = time.time()
+            item.on_finish += start_next
+            running.add(item)
+            pipeline.enqueue(item)
+            return
+
+        if not running:
+            IOLoop.instance().stop()
+
+    started = time.time()
+    for slot in range(args.concurrent):
+        start_next()
+    IOLoop.instance().start()
+    tracker.shutdown()
+
+    return (waits, time.time() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark getting items from a slow tracker.')
+    parser.add_argument('--latency', type=float, default=2,
+        help='seconds the fake tracker takes to answer (default: %(default)s)')
+    parser.add_argument('--work', type=float, default=5,
+        help='seconds each item holds its slot (default: %(default)s)')
+    parser.add_argument('--items', type=int, default=8)
+    parser.add_argument('--concurrent', type=int, default=2)
+    parser.add_argument('--prefetch', type=int, default=2,
+        help='prefetch_items for the prefetch run (default: %(default)s)')
+    args = parser.parse_args()
+
+    if not os.path.exists('pipeline.py'):
+        sys.exit('Run this from the repository root.')
+
+    context = {'downloader': 'benchmark'}
+    with open('pipeline.py') as f:
+        exec f.read() in context, context
+
+    data_dir = tempfile.mkdtemp(prefix='verizon-benchmark-prefetch-')
+    results = []
+
+    try:
+        for mode in ('tracker', 'prefetch'):
+            results.append((mode,) + run(args, context, mode, data_dir))
+    finally:
+        shutil.rmtree(data_dir)
+
+    print('%-10s %14s %14s %10s' % ('items', 'mean wait (s)',
+        'max wait (s)', 'seconds'))
+    for (mode, waits, seconds) in results:
+        print('%-10s %14.2f %14.2f %10.1f' % (mode, sum(waits) / len(waits),
+            max(waits), seconds))
+
+    # The first items have to wait either way.
+    tracker_waits = results[0][1][args.concurrent:]
+    prefetch_waits = results[1][1][args.concurrent:]
+    if tracker_waits:
+        print('After the first %d items, prefetching hid %.0f%% of the '
+            'tracker wait.' % (args.concurrent, 100 * (1 - sum(prefetch_waits)
+            / max(sum(tracker_waits), 1e-9))))
+
+    # Skip waiting for the pipeline's threads.
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
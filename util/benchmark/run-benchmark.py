@@ -0,0 +1,279 @@
+'''Runs the real pipeline against local stand-ins and reports how fast it
+goes, so that changes can be compared against a baseline without touching
+the real sites or the tracker.
+
+For each item type it starts a synthetic site server (used by Wget+Lua as
+its HTTP proxy), a fake tracker that hands out --items made-up items, and
+an rsync daemon to upload to. It then runs run-pipeline from the
+repository root until those items are done, and reports items/hour, URLs
+and bytes per second (from the pipeline's metrics log), the peak RSS of
+the pipeline and its Wget+Lua processes and the CPU time of the pipeline
+process itself.
+
+With --batch-upload-mb 0,500 it runs each item type once for each
+batch_upload_mb value and reports items per minute instead, counting the
+items the fake tracker was told are done, which with batches happens only
+once their batch has been uploaded to the rsync daemon.
+
+Needs wget-lua (as for the real pipeline), rsync and Linux (for /proc).
+Run it from the repository root:
+
+    python util/benchmark/run-benchmark.py --items 4 --concurrent 2
+'''
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+from standins import SiteConfig, SiteServer, TrackerServer, RsyncDaemon
+
+
+ITEM_TYPES = ['verizon', 'bellatlantic', 'verizon36pack',
+    'bellatlantic36pack']
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def item_names(item_type, count, seed):
+    rand = random.Random('%s:%s' % (seed, item_type))
+    return ['%s:bench%s' % (item_type, ''.join(
+        rand.choice(string.lowercase) for i in range(6)))
+        for n in range(count)]
+
+
+def process_tree_rss(pid):
+    '''Returns the resident memory of a process and all its descendants, in
+    bytes.'''
+    children = {}
+    rss = {}
+
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+
+        try:
+            with open('/proc/%s/status' % name) as f:
+                status = dict(line.split(':', 1) for line in f if ':' in line)
+        except IOError:
+            continue
+
+        ppid = int(status['PPid'])
+        children.setdefault(ppid, []).append(int(name))
+        if 'VmRSS' in status:
+            rss[int(name)] = int(status['VmRSS'].split()[0]) * 1024
+
+    total = 0
+    todo = [pid]
+    while todo:
+        pid = todo.pop()
+        total += rss.get(pid, 0)
+        todo.extend(children.get(pid, []))
+
+    return total
+
+
+def process_cpu_seconds(pid):
+    '''Returns the user and system CPU time a process has used so far, in
+    seconds, not counting its children.'''
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            # The command name can have spaces, the fields after it cannot.
+            fields = f.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return 0
+
+    return (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf('SC_CLK_TCK'))
+
+
+def run_item_type(args, item_type, work_dir, context_values=()):
+    site = SiteServer(SiteConfig(depth=args.depth, fanout=args.fanout,
+        assets=args.assets, asset_size=args.asset_size,
+        missing_ratio=args.missing_ratio, broken_ratio=args.broken_ratio,
+        error_ratio=args.error_ratio, seed=args.seed)).start()
+    rsync = RsyncDaemon(free_port())
+    tracker = TrackerServer(item_names(item_type, args.items, args.seed),
+        rsync.target, latency=args.tracker_latency).start()
+    name = '-'.join((item_type,) + tuple(context_values))
+    metrics_log = os.path.join(work_dir, 'metrics-%s.jsonl' % name)
+
+    command = [args.run_pipeline, 'pipeline.py', 'benchmark',
+        '--concurrent', str(args.concurrent),
+        '--max-items', str(args.items),
+        '--disable-web-server',
+        '--stop-file', os.path.join(work_dir, 'STOP'),
+        '--context-value', 'tracker_host=%s' % tracker.host,
+        '--context-value', 'http_proxy=%s' % site.proxy_url,
+        '--context-value', 'metrics_log=%s' % metrics_log]
+    for value in args.context_value + list(context_values):
+        command.extend(['--context-value', value])
+
+    with open(os.path.join(work_dir, 'pipeline-%s.log' % name),
+            'w') as log:
+        started = time.time()
+        process = subprocess.Popen(command, stdout=log,
+            stderr=subprocess.STDOUT)
+        peak_rss = 0
+        pipeline_cpu = 0
+
+        try:
+            while process.poll() is None:
+                peak_rss = max(peak_rss, process_tree_rss(process.pid))
+                pipeline_cpu = max(pipeline_cpu,
+                    process_cpu_seconds(process.pid))
+                time.sleep(0.5)
+
+                if time.time() - started > args.timeout:
+                    process.terminate()
+                    process.wait()
+                    break
+        finally:
+            elapsed = time.time() - started
+            uploaded = rsync.uploaded_bytes()
+            rsync.stop()
+            tracker.shutdown()
+            site.shutdown()
+
+    records = []
+    if os.path.exists(metrics_log):
+        with open(metrics_log) as f:
+            records = [json.loads(line) for line in f]
+
+    completed = [record for record in records
+        if record['outcome'] == 'completed']
+    urls = sum(record.get('wget_stats', {}).get('urls', 0)
+        for record in records)
+    downloaded = sum(record.get('wget_stats', {}).get('bytes', 0)
+        for record in records)
+    retries = sum(record.get('wget_stats', {}).get('retries', 0)
+        for record in records)
+    deferred = sum(record.get('wget_stats', {}).get('deferred', 0)
+        for record in records)
+
+    return {
+        'item_type': item_type,
+        'items': len(completed),
+        'failed': len(records) - len(completed),
+        'seconds': elapsed,
+        'items_per_hour': len(completed) * 3600 / elapsed,
+        # Marked as done on the tracker, which happens after the upload.
+        'uploaded_items': len(tracker.done_items),
+        'items_per_minute': len(tracker.done_items) * 60 / elapsed,
+        'urls_per_second': urls / elapsed,
+        'bytes_per_second': downloaded / elapsed,
+        'uploaded_bytes': uploaded,
+        'site_requests': site.requests,
+        'site_urls': len(site.last_status),
+        'success_rate': site.success_rate(),
+        'retries': retries,
+        'deferred': deferred,
+        'peak_rss_mb': peak_rss / 1024.0 / 1024.0,
+        'pipeline_cpu_seconds': pipeline_cpu,
+    }
+
+
+def argument_parser(description):
+    '''The options of run_item_type, shared with the other benchmarks
+    that run the whole pipeline.'''
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--items', type=int, default=4,
+        help='items per item type (default: %(default)s)')
+    parser.add_argument('--concurrent', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--assets', type=int, default=3)
+    parser.add_argument('--asset-size', type=int, default=20000)
+    parser.add_argument('--missing-ratio', type=float, default=0.5)
+    parser.add_argument('--broken-ratio', type=float, default=0.2)
+    parser.add_argument('--error-ratio', type=float, default=0.0)
+    parser.add_argument('--seed', default='1')
+    parser.add_argument('--tracker-latency', type=float, default=0,
+        help='seconds the fake tracker takes to answer (default: %(default)s)')
+    parser.add_argument('--timeout', type=int, default=3600,
+        help='seconds to give each item type (default: %(default)s)')
+    parser.add_argument('--run-pipeline', default='run-pipeline')
+    parser.add_argument('--context-value', action='append', default=[],
+        help='passed on to run-pipeline, e.g. wget_shards=4')
+
+    return parser
+
+
+def main():
+    parser = argument_parser(
+        'Benchmark the pipeline against local stand-ins.')
+    parser.add_argument('--types', default=','.join(ITEM_TYPES),
+        help='comma-separated item types (default: %(default)s)')
+    parser.add_argument('--batch-upload-mb',
+        help='compare these comma-separated batch_upload_mb values, e.g. '
+        '0,500, in items per minute')
+    parser.add_argument('--json', action='store_true',
+        help='print the results as JSON lines')
+    args = parser.parse_args()
+
+    if not os.path.exists('pipeline.py'):
+        sys.exit('Run this from the repository root.')
+
+    work_dir = tempfile.mkdtemp(prefix='verizon-benchmark-')
+    results = []
+
+    try:
+        for item_type in args.types.split(','):
+            if args.batch_upload_mb is None:
+                results.append(run_item_type(args, item_type, work_dir))
+                continue
+
+            for size in args.batch_upload_mb.split(','):
+                result = run_item_type(args, item_type, work_dir,
+                    ['batch_upload_mb=%s' % size])
+                result['batch_upload_mb'] = int(size)
+                results.append(result)
+    finally:
+        if results and not any(result['failed'] for result in results):
+            shutil.rmtree(work_dir)
+        else:
+            print('Logs are in %s' % work_dir)
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+
+    if args.batch_upload_mb is not None:
+        print_batch_results(results)
+        return
+
+    print('%-20s %6s %6s %9s %10s %8s %12s %9s %8s' % ('item type', 'items',
+        'failed', 'seconds', 'items/hour', 'URLs/s', 'bytes/s', 'RSS (MB)',
+        'CPU (s)'))
+    for result in results:
+        print('%(item_type)-20s %(items)6d %(failed)6d %(seconds)9.1f '
+            '%(items_per_hour)10.1f %(urls_per_second)8.2f '
+            '%(bytes_per_second)12.0f %(peak_rss_mb)9.1f '
+            '%(pipeline_cpu_seconds)8.1f' % result)
+
+
+
+def print_batch_results(results):
+    print('%-20s %9s %8s %6s %9s %9s %14s' % ('item type', 'batch MB',
+        'uploaded', 'failed', 'seconds', 'items/min', 'uploaded bytes'))
+    for result in results:
+        print('%(item_type)-20s %(batch_upload_mb)9d %(uploaded_items)8d '
+            '%(failed)6d %(seconds)9.1f %(items_per_minute)9.2f '
+            '%(uploaded_bytes)14d' % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+-- Micro-benchmark for the scope check in verizon.lua.
+--
+-- Compares wget.callbacks.download_child_p with the old if/elseif chain
+-- over a synthetic set of links. Run it from the repository root:
+--
+--   item_type=verizon1296pack item_value=ab item_host=mysite.verizon.net \
+--     item_suffix_length=2 item_alphabet=0123456789abcdefghijklmnopqrstuvwxyz \
+--     lua util/benchmark/scope-matcher.lua
+
+local link_count = tonumber(arg and arg[1]) or 200000
+local item_type = os.getenv('item_type')
+local item_value = os.getenv('item_value')
+
+wget = { callbacks = {}, actions = { NOTHING = 0, CONTINUE = 1, EXIT = 2, ABORT = 3 } }
+dofile("verizon.lua")
+
+-- The scope check before it was replaced by a table lookup (trimmed to the
+-- pack branches; the single user branches were the same apart from the
+-- comparison).
+local old_download_child_p = function(urlpos, parent, depth, start_url_parsed, iri, verdict, reason)
+  local url = urlpos["url"]["url"]
+
+  if url == "http://entertainment.verizon.com/" then
+    return false
+  elseif url == ("http://verizon.net/" or "https://verizon.net/") then
+    return false
+  elseif string.match(url, "//////////") then
+    return false
+  elseif string.match(url, "bellatlantic%.net/([^/]+)/") or
+    string.match(url, "verizon%.net/([^/]+)/") then
+    local pattern = "verizon%.net/([^/]+)/"
+    if string.match(item_type, "^bellatlantic") then
+      pattern = "bellatlantic%.net/([^/]+)/"
+    end
+    local directory = string.match(url, pattern)
+    if not directory then
+      return false
+    end
+    directory = string.gsub(directory, '%%7E', '~')
+    if not string.match(directory, item_value) then
+      return false
+    else
+      return verdict
+    end
+  else
+    return verdict
+  end
+end
+
+local host = "mysite.verizon.net"
+if string.match(item_type, "^bellatlantic") then
+  host = "members.bellatlantic.net"
+end
+
+local alphabet = "0123456789abcdefghijklmnopqrstuvwxyz"
+local random_name = function(length)
+  local name = ""
+  for i = 1, length do
+    local n = math.random(1, #alphabet)
+    name = name .. string.sub(alphabet, n, n)
+  end
+  return name
+end
+
+math.randomseed(1)
+local links = {}
+for i = 1, link_count do
+  local kind = i % 4
+  local url
+  if kind == 0 then
+    url = "http://" .. host .. "/" .. item_value .. random_name(2) .. "/page" .. i .. ".html"
+  elseif kind == 1 then
+    url = "http://" .. host .. "/" .. random_name(6) .. "/images/" .. i .. ".gif"
+  elseif kind == 2 then
+    url = "http://counter" .. (i % 50) .. ".example.com/hit?id=" .. i
+  else
+    url = "http://" .. host .. "/%7E" .. random_name(4) .. "/"
+  end
+  links[i] = { url = { url = url, host = host } }
+end
+
+local run = function(name, callback)
+  local accepted = 0
+  local started = os.clock()
+  for i = 1, link_count do
+    if callback(links[i], nil, 1, nil, nil, true, nil) then
+      accepted = accepted + 1
+    end
+  end
+  local elapsed = os.clock() - started
+  io.stdout:write(string.format("%-8s %8d links %8d accepted %8.3f s %10.0f links/s\n",
+    name, link_count, accepted, elapsed, link_count / elapsed))
+end
+
+run("old", old_download_child_p)
+run("new", wget.callbacks.download_child_p)
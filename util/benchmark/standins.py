@@ -0,0 +1,302 @@
+'''Local stand-ins for the services the pipeline talks to, for
+run-benchmark.py:
+
+* SiteServer makes up mysite.verizon.net and members.bellatlantic.net
+  homepages. Wget+Lua reaches it as its HTTP proxy, so every host name
+  ends up here.
+* TrackerServer hands out a fixed list of items and collects the done
+  requests, optionally taking latency seconds to answer each request.
+* RsyncDaemon is an rsync daemon with one writable module to upload to.
+* FailureServer collects the bulk failure reports, answering with the
+  status codes in statuses first, for outages.
+'''
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import random
+import shutil
+import SocketServer
+import subprocess
+import tempfile
+import threading
+import time
+import urlparse
+
+
+OWN_HOSTS = {
+    'mysite.verizon.net': 'http://www.verizon.net/',
+    'members.bellatlantic.net': 'http://www.bellatlantic.net/',
+}
+
+
+class SiteConfig(object):
+    '''What the synthetic homepages look like.
+
+    Every homepage is a tree of pages, depth levels deep, where each page
+    links to fanout pages on the next level and embeds assets images of
+    asset_size bytes. A missing_ratio share of the homepages do not exist
+    and redirect the way the real ones do, a broken_ratio share of the
+    pages also link to a page that is not there, and an error_ratio share
+    of all requests fail with a 503.'''
+    def __init__(self, depth=2, fanout=4, assets=3, asset_size=20000,
+            missing_ratio=0.5, broken_ratio=0.2, error_ratio=0.0, seed='1'):
+        self.depth = depth
+        self.fanout = fanout
+        self.assets = assets
+        self.asset_size = asset_size
+        self.missing_ratio = missing_ratio
+        self.broken_ratio = broken_ratio
+        self.error_ratio = error_ratio
+        self.seed = seed
+
+    def chance(self, *keys):
+        '''A number in [0, 1) that is always the same for the same keys.'''
+        digest = hashlib.md5('\0'.join((self.seed,) + keys)).hexdigest()
+        return int(digest[:8], 16) / float(0x100000000)
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+
+class QuietHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body='', content_type='text/html', headers=()):
+        self.status = status
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+        return len(body)
+
+
+class SiteHandler(QuietHandler):
+    def do_GET(self):
+        # Proxied requests carry the full URL.
+        url = urlparse.urlsplit(self.path)
+        host = url.netloc or self.headers.get('Host', '')
+        config = self.server.config
+
+        if random.random() < config.error_ratio:
+            size = self.reply(503, 'Service Unavailable')
+        elif host in OWN_HOSTS:
+            size = self.own_host(host, url.path)
+        else:
+            size = self.reply(200, '<html><body>%s</body></html>' % host)
+
+        self.server.count(self.path, self.status, size)
+
+    def own_host(self, host, path):
+        config = self.server.config
+        parts = path.split('/')
+
+        if len(parts) < 3 or not parts[1]:
+            return self.reply(302, headers=[('Location', OWN_HOSTS[host])])
+
+        user = parts[1]
+        name = '/'.join(parts[2:])
+
+        if config.chance(host, user) < config.missing_ratio:
+            return self.reply(302, headers=[('Location', OWN_HOSTS[host])])
+        elif name == '' or name == 'index.html':
+            return self.reply(200, self.page(host, user, ''))
+        elif name.startswith('page-') and name.endswith('.html'):
+            page = name[len('page-'):-len('.html')]
+            if len(page.split('-')) <= config.depth:
+                return self.reply(200, self.page(host, user, page))
+        elif name.startswith('images/'):
+            return self.reply(200, self.server.asset(), 'image/jpeg')
+
+        return self.reply(404, 'Not Found')
+
+    def page(self, host, user, page):
+        config = self.server.config
+        level = len(page.split('-')) if page else 0
+        prefix = page + '-' if page else ''
+        links = []
+
+        if level < config.depth:
+            for i in range(config.fanout):
+                links.append('<a href="page-%s%d.html">page %d</a>' % (
+                    prefix, i, i))
+        for i in range(config.assets):
+            links.append('<img src="images/%s%d.jpg">' % (prefix, i))
+        if config.chance(host, user, page) < config.broken_ratio:
+            links.append('<a href="gone-%s.html">gone</a>' % (
+                page or 'home'))
+
+        links.append('<a href="/%s/">home</a>' % user)
+        links.append('<a href="http://www.verizon.com/">Verizon</a>')
+
+        return '<html><body><h1>%s %s</h1>\n%s\n</body></html>' % (
+            user, page, '\n'.join(links))
+
+
+class SiteServer(ThreadingHTTPServer):
+    def __init__(self, config, port=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), SiteHandler)
+        self.config = config
+        self.requests = 0
+        self.bytes = 0
+        self.last_status = {}
+        self._asset = os.urandom(config.asset_size)
+        self._lock = threading.Lock()
+
+    def asset(self):
+        return self._asset
+
+    def count(self, url, status, size):
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+            self.last_status[url] = status
+
+    def success_rate(self):
+        '''The share of the URLs that were requested whose last response
+        was not a server error.'''
+        with self._lock:
+            if not self.last_status:
+                return 0.0
+
+            return sum(1 for status in self.last_status.itervalues()
+                if status < 500) / float(len(self.last_status))
+
+    @property
+    def proxy_url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+class TrackerHandler(QuietHandler):
+    def do_POST(self):
+        data = json.loads(self.rfile.read(
+            int(self.headers.get('Content-Length', 0))) or '{}')
+        command = self.path.rstrip('/').rsplit('/', 1)[-1]
+
+        # A busy tracker far away
+        time.sleep(self.server.latency)
+
+        if command == 'request':
+            item_name = self.server.next_item()
+            if item_name:
+                self.reply(200, json.dumps({'item_name': item_name}),
+                    'application/json')
+            else:
+                self.reply(404, 'No item received.')
+        elif command == 'upload':
+            self.reply(200, json.dumps({
+                'upload_target': self.server.upload_target}),
+                'application/json')
+        elif command == 'done':
+            self.server.done(data)
+            self.reply(200, 'OK', 'text/plain')
+        else:
+            self.reply(404, 'Not Found')
+
+
+class TrackerServer(ThreadingHTTPServer):
+    def __init__(self, item_names, upload_target, port=0, latency=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port),
+            TrackerHandler)
+        self.upload_target = upload_target
+        self.latency = latency
+        self.done_items = []
+        self._queue = list(item_names)
+        self._lock = threading.Lock()
+
+    def next_item(self):
+        with self._lock:
+            if self._queue:
+                return self._queue.pop(0)
+
+    def done(self, data):
+        with self._lock:
+            self.done_items.append((time.time(), data))
+
+    @property
+    def host(self):
+        return '127.0.0.1:%d' % self.server_address[1]
+
+
+class FailureHandler(QuietHandler):
+    def do_POST(self):
+        data = json.loads(self.rfile.read(
+            int(self.headers.get('Content-Length', 0))) or '[]')
+        status = self.server.receive(self.path, data)
+        self.reply(status, 'OK' if status == 200 else 'Unavailable',
+            'text/plain')
+
+
+class FailureServer(ThreadingHTTPServer):
+    def __init__(self, port=0, statuses=()):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port),
+            FailureHandler)
+        self.statuses = list(statuses)
+        self.requests = []
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def receive(self, path, data):
+        with self._lock:
+            self.requests.append((path, len(data)))
+            status = self.statuses.pop(0) if self.statuses else 200
+            if status == 200 and path == '/fail/bulk':
+                self.failures.extend(data)
+
+            return status
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class RsyncDaemon(object):
+    def __init__(self, port):
+        self.port = port
+        self.directory = tempfile.mkdtemp(prefix='verizon-benchmark-rsync-')
+        self.upload_dir = os.path.join(self.directory, 'upload')
+        os.mkdir(self.upload_dir)
+
+        config = os.path.join(self.directory, 'rsyncd.conf')
+        with open(config, 'w') as f:
+            f.write('use chroot = no\n'
+                'pid file = %s/rsyncd.pid\n'
+                '[benchmark]\n'
+                'path = %s\n'
+                'read only = no\n' % (self.directory, self.upload_dir))
+
+        self.process = subprocess.Popen(['rsync', '--daemon', '--no-detach',
+            '--port=%d' % port, '--config=%s' % config])
+
+    @property
+    def target(self):
+        return 'rsync://127.0.0.1:%d/benchmark/' % self.port
+
+    def uploaded_bytes(self):
+        total = 0
+        for (root, dirs, files) in os.walk(self.upload_dir):
+            total += sum(os.path.getsize(os.path.join(root, filename))
+                for filename in files)
+        return total
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,78 @@
+'''Measures how long it takes to load pipeline.py, the way run-pipeline
+does, with and without the cached Wget+Lua lookup in
+data/executables.json. Each load runs in a new process.
+
+Needs wget-lua (as for the real pipeline). Run it from the repository
+root:
+
+    python util/benchmark/startup.py --runs 10
+'''
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+CACHE = os.path.join('data', 'executables.json')
+
+
+def load():
+    '''Loads the pipeline and prints the seconds it took.'''
+    started = time.time()
+    context = {'downloader': 'benchmark'}
+    with open('pipeline.py') as f:
+        exec f.read() in context, context
+    sys.stdout.write('%f\n' % (time.time() - started))
+    sys.stdout.flush()
+
+    # Skip waiting for the pipeline's threads.
+    os._exit(0)
+
+
+def timed_load():
+    output = subprocess.check_output([sys.executable, __file__, '--load'],
+        stderr=open(os.devnull, 'w'))
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark loading pipeline.py.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--load', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        load()
+
+    if not os.path.exists('pipeline.py'):
+        sys.exit('Run this from the repository root.')
+
+    saved = None
+    if os.path.exists(CACHE):
+        with open(CACHE) as f:
+            saved = f.read()
+
+    try:
+        cold = []
+        warm = []
+
+        for run in range(args.runs):
+            if os.path.exists(CACHE):
+                os.remove(CACHE)
+            cold.append(timed_load())
+            warm.append(timed_load())
+    finally:
+        if saved is not None:
+            with open(CACHE, 'w') as f:
+                f.write(saved)
+
+    print('%-12s %8s %8s %8s' % ('cache', 'min (s)', 'mean (s)', 'max (s)'))
+    for (name, times) in (('none', cold), ('warm', warm)):
+        print('%-12s %8.3f %8.3f %8.3f' % (name, min(times),
+            sum(times) / len(times), max(times)))
+
+
+if __name__ == '__main__':
+    main()
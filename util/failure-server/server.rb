@@ -1,5 +1,6 @@
 require 'sinatra'
 require 'analysand'
+require 'json'
 require 'uri'
 
 db_uri = URI(ARGV[0])
@@ -23,6 +24,27 @@ post '/fail' do
   status resp.code
 end
 
+# Takes a JSON array of failures, as sent by the pipeline, and stores them
+# with one request.
+post '/fail/bulk' do
+  failures = JSON.parse(request.body.read)
+  now = Time.now.tai64n
+
+  docs = failures.each_with_index.map do |failure, i|
+    {
+      _id: "#{failure['downloader']}:#{failure['item_name']}:#{now}:#{i}",
+      downloader: failure['downloader'],
+      response_code: failure['response_code'],
+      url: failure['url'],
+      item_name: failure['item_name']
+    }
+  end
+
+  resp = db.bulk_docs(docs, credentials)
+
+  status resp.code
+end
+
 # libtai64-ruby
 # http://cr.yp.to/libtai/tai64.html
 # Further stolen from https://gist.github.com/2983/78cbbfcc1f1dca646aff100e94e29188b5390a5a
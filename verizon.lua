@@ -1,9 +1,83 @@
 local url_count = 0
-local tries = 0
 local item_type = os.getenv('item_type')
 local item_value = os.getenv('item_value')
+local item_dir = os.getenv('item_dir')
+local shard_suffix = os.getenv('shard_suffix') or ''
 dofile("failure_report.lua")
 
+-- The homepage directories that belong to this item ("joe" for a single
+-- user, "ab0" to "abz" for a 36pack and "ab00" to "abzz" for a 1296pack),
+-- so that checking a link is a single table lookup. The host, suffix
+-- length and alphabet come from the item types in the pipeline.
+local item_host = os.getenv('item_host')
+local item_suffix_length = tonumber(os.getenv('item_suffix_length'))
+local item_alphabet = os.getenv('item_alphabet')
+local item_directories = {}
+
+local add_item_directories
+add_item_directories = function(prefix, length)
+  if length == 0 then
+    item_directories[prefix] = true
+  else
+    for i = 1, #item_alphabet do
+      add_item_directories(prefix .. string.sub(item_alphabet, i, i), length - 1)
+    end
+  end
+end
+
+-- shouldn't be anything else!
+assert(item_host and item_suffix_length and item_alphabet)
+add_item_directories(item_value, item_suffix_length)
+local item_directory_pattern = string.gsub(item_host, "%.", "%%.") .. "/([^/]+)/"
+
+-- Where mysite.verizon.net and members.bellatlantic.net redirect to
+local skipped_urls = {
+  ["http://entertainment.verizon.com/"] = true,
+  ["http://verizon.net/"] = true,
+  ["https://verizon.net/"] = true,
+  ["http://www.verizon.net/"] = true,
+  ["https://www.verizon.net/"] = true,
+  ["http://bellatlantic.net/"] = true,
+  ["https://bellatlantic.net/"] = true,
+  ["http://www.bellatlantic.net/"] = true,
+  ["https://www.bellatlantic.net/"] = true
+}
+
+-- The pipeline runs a rate limiter that is shared by all Wget+Lua
+-- processes. We ask it for a token through its request FIFO and wait for
+-- the token on our own grant FIFO.
+local rate_limiter = os.getenv('rate_limiter')
+local rate_grant = nil
+local limiter_requests = nil
+local limiter_grants = nil
+
+if rate_limiter then
+  rate_grant = item_dir .. "/rate-limiter" .. shard_suffix .. ".fifo"
+  limiter_requests = assert(io.open(rate_limiter, "w"))
+  limiter_grants = assert(io.open(rate_grant, "r"))
+end
+
+-- Checkpoints (see the pipeline): we skip the URLs that are in the WARC
+-- segments of earlier runs, and note every URL we want, so that a run
+-- that is stopped can be carried on by the next one.
+local checkpoint_dir = os.getenv('checkpoint_dir')
+local done_urls = {}
+local queued_urls = {}
+local queued_file = nil
+
+if checkpoint_dir then
+  local f = io.open(checkpoint_dir .. "/done" .. shard_suffix .. ".txt")
+  if f then
+    for url in f:lines() do
+      done_urls[url] = true
+    end
+    f:close()
+  end
+
+  queued_file = assert(io.open(checkpoint_dir .. "/queued" .. shard_suffix .. ".txt", "a"))
+  queued_file:setvbuf("line")
+end
+
 read_file = function(file)
   if file then
     local f = assert(io.open(file))
@@ -15,174 +89,277 @@ read_file = function(file)
   end
 end
 
+-- Returns false if there is no rate limiter to wait for.
+local wait_for_token = function(host, status_code)
+  if not limiter_requests then
+    return false
+  end
+
+  limiter_requests:write(host .. "\t" .. status_code .. "\t" .. rate_grant .. "\n")
+  limiter_requests:flush()
+
+  if limiter_grants:read("*l") then
+    return true
+  end
+
+  -- The pipeline went away
+  limiter_requests = nil
+  return false
+end
+
+-- Error state for each host, so that one failing host neither holds up
+-- nor resets the others. After circuit_threshold failures in a row the
+-- circuit of a host opens for circuit_cooldown seconds: its failing and
+-- newly found URLs are put aside in a file, and the pipeline gives them
+-- to one more Wget+Lua process (the retry pass) at the end of the item,
+-- which skips the URLs that are in the WARC already through its done file.
+local backoff_base = 5
+local backoff_max = 120
+local circuit_threshold = 5
+local circuit_cooldown = 300
+local retry_pass = os.getenv('retry_pass')
+local hosts = {}
+local deferred_urls = {}
+local deferred_file = nil
+
+-- Counted for the pipeline's metrics and written out when Wget finishes.
+local retry_count = 0
+local deferred_count = 0
+local sleep_seconds = 0
+
+local host_state = function(host)
+  if not hosts[host] then
+    hosts[host] = { failures = 0, open_until = 0 }
+  end
+  return hosts[host]
+end
+
+local circuit_is_open = function(host)
+  return hosts[host] ~= nil and os.time() < hosts[host].open_until
+end
+
+local defer_url = function(url)
+  if deferred_urls[url] then
+    return
+  end
+  deferred_urls[url] = true
+  deferred_count = deferred_count + 1
+
+  if not deferred_file then
+    deferred_file = assert(io.open(item_dir .. "/deferred" .. shard_suffix .. ".txt", "a"))
+  end
+  deferred_file:write(url .. "\n")
+  deferred_file:flush()
+end
+
+local backoff = function(state)
+  -- Exponential, with jitter so that processes which failed together do
+  -- not all come back at the same moment.
+  local delay = math.min(backoff_max, backoff_base * 2 ^ (state.failures - 1))
+  delay = delay * (0.5 + math.random() / 2)
+
+  io.stdout:write("Sleeping "..string.format("%.1f", delay).." seconds.\n")
+  io.stdout:flush()
+  os.execute("sleep " .. string.format("%.1f", delay))
+  sleep_seconds = sleep_seconds + delay
+end
+
 local admit_failure = function(status_code, url)
   io.stdout:write("Giving up on "..url.."\n")
   io.stdout:flush()
   log_failure(status_code, url, os.getenv('downloader'), item_type, item_value)
 end
 
-wget.callbacks.download_child_p = function(urlpos, parent, depth, start_url_parsed, iri, verdict, reason)
+local want_url = function(urlpos, verdict)
   local url = urlpos["url"]["url"]
 
   -- Skip redirect from mysite.verizon.net and members.bellatlantic.net
-  if url == "http://entertainment.verizon.com/" then
-    return false
-  elseif url == ("http://verizon.net/" or "https://verizon.net/" or "http://www.verizon.net/" or "https://www.verizon.net/" or "http://bellatlantic.net/" or "https://bellatlantic.net/" or "http://www.bellatlantic.net/" or "https://www.bellatlantic.net/") then
+  if skipped_urls[url] then
     return false
   elseif string.match(url, "//////////") then
     return false
-  elseif string.match(url, "bellatlantic%.net/([^/]+)/") or
-    string.match(url, "verizon%.net/([^/]+)/") then
-    if item_type == "verizon" then
-      local directory_name_verizon = string.match(url, "verizon%.net/([^/]+)/")
-      directory_name_verizon = string.gsub(directory_name_verizon, '%%7E', '~')
-      if directory_name_verizon ~= item_value then
-        -- do not want someone else's homepage
-        -- io.stdout:write("\n Reject " .. url .. " " .. directory_name_verizon .. "\n")
-        -- io.stdout:flush()
-        return false
-      else
-        return verdict
-      end
-    elseif item_type == "bellatlantic" then
-      local directory_name_bellatlantic = string.match(url, "bellatlantic%.net/([^/]+)/")
-      directory_name_bellatlantic = string.gsub(directory_name_bellatlantic, '%%7E', '~')
-      if directory_name_bellatlantic ~= item_value then
-        -- do not want someone else's homepage
-        -- io.stdout:write("\n Reject " .. url .. " " .. directory_name_bellatlantic .. "\n")
-        -- io.stdout:flush()
-        return false
-      else
-        return verdict
-      end
-    elseif item_type == "bellatlantic36pack" then
-      local directory_name_bellatlantic36pack = string.match(url, "bellatlantic%.net/([^/]+)/")
-      directory_name_bellatlantic36pack = string.gsub(directory_name_bellatlantic36pack, '%%7E', '~')
-      if not string.match(directory_name_bellatlantic36pack, item_value) then
-        -- do not want someone else's homepage
-        -- io.stdout:write("\n Reject " .. url .. " " .. directory_name_bellatlantic36pack .. "\n")
-        -- io.stdout:flush()
-        return false
-      else
-        return verdict
-      end
-    elseif item_type == "verizon36pack" then
-      local directory_name_verizon36pack = string.match(url, "verizon%.net/([^/]+)/")
-      directory_name_verizon36pack = string.gsub(directory_name_verizon36pack, '%%7E', '~')
-      if not string.match(directory_name_verizon36pack, item_value) then
-        -- do not want someone else's homepage
-        -- io.stdout:write("\n Reject " .. url .. " " .. directory_name_verizon36pack .. "\n")
-        -- io.stdout:flush()
-        return false
-      else
-        return verdict
-      end
-    elseif item_type == "verizon1296pack" then
-      local directory_name_verizon1296pack = string.match(url, "verizon%.net/([^/]+)/")
-      directory_name_verizon1296pack = string.gsub(directory_name_verizon1296pack, '%%7E', '~')
-      if not string.match(directory_name_verizon1296pack, item_value) then
-        -- do not want someone else's homepage
-        -- io.stdout:write("\n Reject " .. url .. " " .. directory_name_verizon1296pack .. "\n")
-        -- io.stdout:flush()
-        return false
-      else
-        return verdict
-      end
-    elseif item_type == "bellatlantic1296pack" then
-      local directory_name_bellatlantic1296pack = string.match(url, "bellatlantic%.net/([^/]+)/")
-      directory_name_bellatlantic1296pack = string.gsub(directory_name_bellatlantic1296pack, '%%7E', '~')
-      if not string.match(directory_name_bellatlantic1296pack, item_value) then
-        -- do not want someone else's homepage
-        -- io.stdout:write("\n Reject " .. url .. " " .. directory_name_bellatlantic1296pack .. "\n")
-        -- io.stdout:flush()
-        return false
-      else
-        return verdict
-      end
+  end
+
+  local directory = string.match(url, item_directory_pattern)
+
+  if directory then
+    directory = string.gsub(directory, "%%7E", "~")
+
+    if item_directories[directory] then
+      return verdict
     else
-      -- shouldn't reach here!
-      assert(false)
+      -- do not want someone else's homepage
+      return false
     end
+  elseif string.match(url, "bellatlantic%.net/[^/]+/") or
+    string.match(url, "verizon%.net/[^/]+/") then
+    -- a homepage on the other site
+    return false
   else
     return verdict
   end
 end
 
+wget.callbacks.download_child_p = function(urlpos, parent, depth, start_url_parsed, iri, verdict, reason)
+  local wanted = want_url(urlpos, verdict)
+  local url = urlpos["url"]["url"]
+
+  if wanted and done_urls[url] then
+    return false
+  elseif wanted and queued_file and not queued_urls[url] then
+    queued_urls[url] = true
+    queued_file:write(url .. "\n")
+  end
+
+  if wanted and not retry_pass and circuit_is_open(urlpos["url"]["host"]) then
+    defer_url(url)
+    return false
+  end
+
+  return wanted
+end
+
+-- Seesaw sends every line we write to the web interface, so progress is
+-- written at most once a second. If the pipeline gives us a url_log
+-- directory, every URL also goes to a file there, which is rotated when it
+-- gets bigger than url_log_max_size.
+local error_count = 0
+local byte_count = 0
+local progress_time = 0
+local url_log_dir = os.getenv('url_log')
+local url_log = nil
+local url_log_name = nil
+local url_log_size = 0
+local url_log_max_size = 10 * 1024 * 1024
+
+if url_log_dir then
+  url_log_name = url_log_dir .. "/" .. item_type .. "-" .. item_value .. shard_suffix .. ".txt"
+  url_log = assert(io.open(url_log_name, "a"))
+  url_log_size = url_log:seek("end")
+end
+
+local log_url = function(status_code, url)
+  local line = status_code .. " " .. url .. "\n"
+  url_log:write(line)
+  url_log_size = url_log_size + #line
+
+  if url_log_size > url_log_max_size then
+    url_log:close()
+    os.rename(url_log_name, url_log_name .. ".1")
+    url_log = assert(io.open(url_log_name, "a"))
+    url_log_size = 0
+  end
+end
+
+local show_progress = function(host)
+  io.stdout:write(url_count .. " URLs, " ..
+    string.format("%.1f", byte_count / 1048576) .. " MB, " ..
+    error_count .. " errors, now at " .. host .. ".  \r")
+  io.stdout:flush()
+end
+
 wget.callbacks.httploop_result = function(url, err, http_stat)
   -- NEW for 2014: Slightly more verbose messages because people keep
   -- complaining that it's not moving or not working
   local status_code = http_stat["statcode"]
+  local host = url["host"]
+  local own_host = string.match(host, "verizon%.net") or
+    string.match(host, "bellatlantic%.net")
   
   url_count = url_count + 1
-  io.stdout:write(url_count .. "=" .. status_code .. " " .. url["url"] .. ".  \r")
-  io.stdout:flush()
-  if status_code >= 500 or
+  byte_count = byte_count + (tonumber(http_stat["len"]) or 0)
+
+  if url_log then
+    log_url(status_code, url["url"])
+  end
+
+  if os.time() ~= progress_time then
+    progress_time = os.time()
+    show_progress(host)
+  end
+
+  if status_code >= 500 or status_code == 0 or
     (status_code >= 400 and status_code ~= 404 and status_code ~= 403) then
-    if string.match(url["host"], "verizon%.net") or
-      string.match(url["host"], "bellatlantic%.net") then
-      if status_code == 423 then
-        admit_failure(status_code, url.url)
+    if own_host and status_code == 423 then
+      admit_failure(status_code, url.url)
+      wait_for_token(host, status_code)
+      return wget.actions.NOTHING
+    end
+
+    error_count = error_count + 1
+
+    if status_code == 0 then
+      io.stdout:write("\nEncounted response code 0 (wget error: "..err..").\n")
+    else
+      io.stdout:write("\nServer returned "..http_stat.statcode..".\n")
+    end
+    io.stdout:flush()
+
+    wait_for_token(host, status_code)
+
+    local state = host_state(host)
+    state.failures = state.failures + 1
+
+    if not retry_pass then
+      if circuit_is_open(host) then
+        defer_url(url["url"])
         return wget.actions.NOTHING
-      end
-      
-      io.stdout:write("\nServer returned "..http_stat.statcode..". Sleeping.\n")
-      io.stdout:flush()
-      
-      os.execute("sleep 10")
-      
-      tries = tries + 1
-      
-      if tries >= 15 then
-        admit_failure(status_code, url.url)
+      elseif state.failures >= circuit_threshold then
+        io.stdout:write("Too many errors from "..host..". Trying its URLs again at the end.\n")
+        io.stdout:flush()
+        state.open_until = os.time() + circuit_cooldown
+        defer_url(url["url"])
         return wget.actions.NOTHING
-      else
-        return wget.actions.CONTINUE
       end
     else
-      io.stdout:write("\nServer returned "..http_stat.statcode..". Sleeping.\n")
-      io.stdout:flush()
-      
-      os.execute("sleep 10")
-      
-      tries = tries + 1
-      
-      if tries >= 5 then
-        io.stdout:write("\nI give up...\n")
-        io.stdout:flush()
+      local max_tries = 5
+      if own_host and status_code ~= 0 then
+        max_tries = 15
+      end
+
+      if state.failures >= max_tries then
+        if status_code == 0 then
+          return wget.actions.ABORT
+        elseif own_host then
+          admit_failure(status_code, url.url)
+        else
+          io.stdout:write("\nI give up...\n")
+          io.stdout:flush()
+        end
         return wget.actions.NOTHING
-      else
-        return wget.actions.CONTINUE
       end
     end
-  elseif status_code == 0 then
-    io.stdout:write("\nEncounted response code 0 (wget error: "..err..").  Sleeping.\n")
-    io.stdout:flush()
-    
-    os.execute("sleep 1")
-    tries = tries + 1
-    
-    if tries >= 5 then
-      -- admit_failure(status_code, url.url)
-      return wget.actions.ABORT
-    else
-      return wget.actions.CONTINUE
-    end
-  end
-
-  tries = 0
 
-  -- We're okay; sleep a bit (if we have to) and continue
-  local sleep_time = 0.1 * (math.random(1000, 2000) / 100.0)
-  -- local sleep_time = 0
+    backoff(state)
+    retry_count = retry_count + 1
+    return wget.actions.CONTINUE
+  end
 
-  --  if string.match(url["host"], "cdn") or string.match(url["host"], "media") then
-  --    -- We should be able to go fast on images since that's what a web browser does
-  --    sleep_time = 0
-  --  end
+  hosts[host] = nil
 
-  if sleep_time > 0.001 then
+  -- We're okay; wait for the rate limiter (or sleep a bit) and continue
+  if not wait_for_token(host, status_code) then
+    local sleep_time = 0.1 * (math.random(1000, 2000) / 100.0)
     os.execute("sleep " .. sleep_time)
+    sleep_seconds = sleep_seconds + sleep_time
   end
 
   return wget.actions.NOTHING
 end
+
+wget.callbacks.finish = function(start_time, end_time, wall_time, numurls, total_downloaded_bytes, total_download_time)
+  show_progress("the end")
+  io.stdout:write("\n")
+
+  if url_log then
+    url_log:close()
+  end
+
+  local f = assert(io.open(item_dir .. "/wget-stats" .. shard_suffix .. ".txt", "a"))
+  f:write("urls " .. numurls .. "\n")
+  f:write("bytes " .. total_downloaded_bytes .. "\n")
+  f:write("retries " .. retry_count .. "\n")
+  f:write("deferred " .. deferred_count .. "\n")
+  f:write("sleep_seconds " .. string.format("%.1f", sleep_seconds) .. "\n")
+  f:close()
+end